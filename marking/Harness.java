@@ -0,0 +1,223 @@
+import java.io.BufferedOutputStream;
+import java.io.BufferedReader;
+import java.io.ByteArrayInputStream;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.FilterOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.OutputStreamWriter;
+import java.io.PrintStream;
+import java.io.Writer;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.util.Arrays;
+import java.util.List;
+import javax.tools.JavaCompiler;
+import javax.tools.JavaFileObject;
+import javax.tools.StandardJavaFileManager;
+import javax.tools.ToolProvider;
+
+/**
+ * Runs student programs inside a long-lived JVM so that each run does not pay
+ * for starting a new one.
+ *
+ * Requests are read from stdin, one per line, as tab separated fields: the
+ * class path, the name of the main class, the input file (empty for no input),
+ * the files that receive stdout and stderr, and the number of bytes the
+ * program may write to them together (0 for no limit). Each program is loaded
+ * in a fresh class loader, so no static state carries over between runs.
+ *
+ * For each request the harness replies on stdout with "EXIT code" once the
+ * program is done. If the run cannot be trusted to match a regular java
+ * process (the class cannot be loaded, the JVM ran out of resources, or the
+ * program left threads running), it replies "COLD" and exits, and the program
+ * should be run again in a new JVM. A program that calls System.exit ends the
+ * harness itself, which the caller sees as the end of stdout. A program that
+ * goes over the output limit is stopped by ending the harness after it
+ * replies "OUTPUT", so no more than the limit is ever written to disk.
+ *
+ * When started with the argument "compile", the harness compiles sources with
+ * the compiler of the JVM instead. Each request holds the class output
+ * directory, the class path, the file that receives the diagnostics, and the
+ * source files, and the reply is "DONE code" with the same code javac would
+ * return.
+ */
+public class Harness {
+    private static final String[] REFLECTION = {
+        "java.lang.reflect.", "jdk.internal.reflect.", "sun.reflect."
+    };
+
+    private static PrintStream replies;
+    private static long limit;
+    private static long written;
+    private static LimitedOutputStream limitedOut;
+    private static LimitedOutputStream limitedErr;
+
+    public static void main(String[] args) throws Exception {
+        BufferedReader requests = new BufferedReader(
+                new InputStreamReader(System.in, "UTF-8"));
+        replies = new PrintStream(
+                new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+
+        if (args.length > 0 && args[0].equals("compile")) {
+            serveCompiles(requests, replies);
+            return;
+        }
+
+        String line;
+        while ((line = requests.readLine()) != null) {
+            String[] fields = line.split("\t", -1);
+            limit = Long.parseLong(fields[5]);
+            written = 0;
+            int code = run(fields[0], fields[1], fields[2], fields[3],
+                    fields[4]);
+            if (code < 0) {
+                replies.println("COLD");
+                break;
+            }
+            replies.println("EXIT " + code);
+        }
+        System.exit(0);
+    }
+
+    private static int run(String classPath, String name, String input,
+            String stdout, String stderr) throws Exception {
+        String[] entries = classPath.split(File.pathSeparator);
+        URL[] urls = new URL[entries.length];
+        for (int i = 0; i < entries.length; i++) {
+            urls[i] = new File(entries[i]).toURI().toURL();
+        }
+
+        InputStream in = input.isEmpty()
+            ? new ByteArrayInputStream(new byte[0])
+            : new FileInputStream(input);
+        limitedOut = new LimitedOutputStream(new BufferedOutputStream(
+                    new FileOutputStream(stdout)));
+        limitedErr = new LimitedOutputStream(new BufferedOutputStream(
+                    new FileOutputStream(stderr)));
+        PrintStream out = new PrintStream(limitedOut, false);
+        PrintStream err = new PrintStream(limitedErr, false);
+
+        InputStream oldIn = System.in;
+        PrintStream oldOut = System.out;
+        PrintStream oldErr = System.err;
+        int threads = Thread.activeCount();
+        int code = 0;
+
+        System.setIn(in);
+        System.setOut(out);
+        System.setErr(err);
+        try (URLClassLoader loader = new URLClassLoader(urls,
+                    ClassLoader.getSystemClassLoader().getParent())) {
+            Class<?> main = Class.forName(name, true, loader);
+            Method method = main.getMethod("main", String[].class);
+            method.invoke(null, (Object) new String[0]);
+        } catch (InvocationTargetException e) {
+            Throwable cause = e.getCause();
+            if (cause instanceof VirtualMachineError) {
+                code = -1;
+            } else {
+                trim(cause);
+                err.print("Exception in thread \"main\" ");
+                cause.printStackTrace(err);
+                code = 1;
+            }
+        } catch (Throwable e) {
+            code = -1;
+        } finally {
+            out.flush();
+            err.flush();
+            System.setIn(oldIn);
+            System.setOut(oldOut);
+            System.setErr(oldErr);
+            in.close();
+            out.close();
+            err.close();
+        }
+
+        if (Thread.activeCount() > threads) {
+            code = -1;
+        }
+        return code;
+    }
+
+    private static void serveCompiles(BufferedReader requests,
+            PrintStream replies) throws Exception {
+        JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+        String line;
+        while ((line = requests.readLine()) != null) {
+            String[] fields = line.split("\t", -1);
+            List<String> options = Arrays.asList("-d", fields[0], "-cp",
+                    fields[1]);
+            List<String> sources = Arrays.asList(fields).subList(3,
+                    fields.length);
+
+            boolean success;
+            try (Writer diagnostics = new OutputStreamWriter(
+                        new FileOutputStream(fields[2]), "UTF-8");
+                    StandardJavaFileManager files =
+                        compiler.getStandardFileManager(null, null, null)) {
+                Iterable<? extends JavaFileObject> units =
+                    files.getJavaFileObjectsFromStrings(sources);
+                success = compiler.getTask(diagnostics, files, null, options,
+                        null, units).call();
+            }
+            replies.println("DONE " + (success ? 0 : 1));
+        }
+    }
+
+    /**
+     * Counts the bytes the program writes to stdout and stderr together. Once
+     * they go over the limit, the part within the limit is written out and the
+     * harness ends, the same way a program run by itself is killed.
+     */
+    private static class LimitedOutputStream extends FilterOutputStream {
+        LimitedOutputStream(OutputStream out) {
+            super(out);
+        }
+
+        @Override
+        public void write(int b) throws IOException {
+            write(new byte[] {(byte) b}, 0, 1);
+        }
+
+        @Override
+        public void write(byte[] b, int off, int len) throws IOException {
+            synchronized (Harness.class) {
+                if (limit > 0 && written + len > limit) {
+                    out.write(b, off, (int) (limit - written));
+                    written = limit;
+                    limitedOut.flush();
+                    limitedErr.flush();
+                    replies.println("OUTPUT");
+                    Runtime.getRuntime().halt(0);
+                }
+                written += len;
+                out.write(b, off, len);
+            }
+        }
+    }
+
+    /**
+     * Removes the frames of the harness from a stack trace, so that it looks
+     * the same as it would when the program is run by itself.
+     */
+    private static void trim(Throwable error) {
+        StackTraceElement[] stack = error.getStackTrace();
+        for (int i = 0; i < stack.length; i++) {
+            for (String prefix : REFLECTION) {
+                if (stack[i].getClassName().startsWith(prefix)) {
+                    error.setStackTrace(Arrays.copyOf(stack, i));
+                    return;
+                }
+            }
+        }
+    }
+}
@@ -0,0 +1,512 @@
+"""
+Measures the throughput of the marking script.
+
+A class of students is made up from the fixtures in the test directory, along
+with programs that are slow, never end, or print far too much. A full marking
+session is then run on it with an editor that does nothing, and the time spent
+in each stage (from the spans of the tracer, which the batch workers record
+too), the number of submissions marked per second, the peak memory, and the
+number of file operations are reported. The results can be saved as
+JSON and compared against an earlier run.
+"""
+
+import argparse
+import configparser
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import utils
+from utils import Editor, GradeTable, SUBMISSION_DIR
+from utils import useTracer, traceSpan
+from marking import readConfigFile, makeComments, makeCSV
+
+# The fixtures the classes are made from.
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'test')
+
+# The programs added to the archetypes of the fixtures. They are named like
+# the fixture programs so they are diffed against the same output.
+SYNTHETIC = {
+    'python': {
+        'slow': 'import time\n'
+                'time.sleep({delay})\n'
+                'print("done")\n',
+        'loop': 'while True:\n'
+                '    pass\n',
+        'huge': 'import sys\n'
+                'line = "x" * 1023 + "\\n"\n'
+                'for i in range({lines}):\n'
+                '    sys.stdout.write(line)\n',
+    },
+    'java': {
+        'slow': 'public class Test {{\n'
+                '    public static void main(String[] args) throws Exception {{\n'
+                '        Thread.sleep({delayMs});\n'
+                '        System.out.println("done");\n'
+                '    }}\n'
+                '}}\n',
+        'loop': 'public class Test {{\n'
+                '    public static void main(String[] args) {{\n'
+                '        while (true) {{ }}\n'
+                '    }}\n'
+                '}}\n',
+        'huge': 'public class Test {{\n'
+                '    public static void main(String[] args) {{\n'
+                '        String line = "x".repeat(1023);\n'
+                '        for (int i = 0; i < {lines}; i++) {{\n'
+                '            System.out.println(line);\n'
+                '        }}\n'
+                '    }}\n'
+                '}}\n',
+    },
+}
+
+# The audit events counted as file operations.
+FILE_EVENTS = {'open', 'os.remove', 'os.rename', 'os.link', 'os.symlink',
+        'os.mkdir', 'os.rmdir', 'os.listdir', 'os.scandir', 'os.chmod',
+        'os.utime', 'shutil.copyfile', 'shutil.copymode', 'shutil.copystat',
+        'shutil.rmtree'}
+
+class FileOpCounter:
+    """
+    Counts file operations through audit hooks.
+
+    Audit hooks cannot be removed, so the counter only counts while it is
+    enabled. Only the operations of this process are seen, so the ones made by
+    batch workers and the student programs are left out.
+
+    Attributes
+    ----------
+    counts:
+        The number of times each event was raised.
+    enabled:
+        Whether events are being counted.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.enabled = False
+
+    def install(self):
+        """
+        Adds the audit hook. This can only be done once per counter.
+        """
+        def hook(event, args):
+            if self.enabled and event in FILE_EVENTS:
+                self.counts[event] = self.counts.get(event, 0) + 1
+        sys.addaudithook(hook)
+
+class NullEditor(Editor):
+    """
+    An editor that returns straight away and leaves the rubric as it is.
+    """
+    def run(self, files):
+        pass
+
+def parseMix(text, archetypes):
+    """
+    Parses the weights of the archetypes given on the command line.
+
+    Parameters
+    ----------
+    text:
+        The weights, as name=weight pairs separated by commas.
+    archetypes:
+        The names of the archetypes that can be used.
+
+    Returns
+    -------
+        A dictionary with the weight of each archetype.
+    """
+    weights = {}
+    for pair in filter(None, [pair.strip() for pair in text.split(',')]):
+        name, weight = pair.split('=')
+        name = name.strip()
+        if name not in archetypes:
+            raise ValueError('unknown archetype {}, expected one of {}'.format(
+                name, ', '.join(sorted(archetypes))))
+        weights[name] = float(weight)
+    return weights
+
+def findArchetypes(fixtureDir):
+    """
+    Finds the students of a fixture, keyed by the id in the name of their
+    directory.
+
+    Parameters
+    ----------
+    fixtureDir:
+        The directory of the fixture of a language.
+
+    Returns
+    -------
+        A dictionary with the submission directory of each archetype.
+    """
+    archetypes = {}
+    root = os.path.join(fixtureDir, 'root')
+    for entry in sorted(os.scandir(root), key = lambda entry: entry.name):
+        match = re.search(r'\((\w+)\)$', entry.name)
+        if entry.is_dir() and match:
+            archetypes[match.group(1)] = os.path.join(entry.path,
+                    SUBMISSION_DIR)
+    return archetypes
+
+def makeClass(args, benchDir):
+    """
+    Makes up the root and config file of a class of students.
+
+    Parameters
+    ----------
+    args:
+        The parsed command line arguments.
+    benchDir:
+        The directory the class is made in.
+
+    Returns
+    -------
+        The path to the config file and the number of students of each
+        archetype.
+    """
+    fixtureDir = os.path.join(FIXTURES, args.lang)
+    archetypes = findArchetypes(fixtureDir)
+    synthetic = SYNTHETIC[args.lang]
+    names = list(archetypes) + list(synthetic)
+
+    weights = {name: 1.0 for name in archetypes}
+    weights.update({'slow': 1.0, 'loop': 0.05, 'huge': 0.05})
+    weights.update(parseMix(args.mix, names))
+    names = [name for name in names if weights.get(name, 0) > 0]
+
+    # Copy the instructor files, but not the students of the fixture.
+    for entry in os.scandir(fixtureDir):
+        if entry.is_file():
+            shutil.copy(entry.path, benchDir)
+    # The fixture programs read test.txt, which the fixture names Test.txt.
+    auxPath = os.path.join(benchDir, 'Test.txt')
+    if os.path.isfile(auxPath):
+        shutil.copy(auxPath, os.path.join(benchDir, 'test.txt'))
+
+    sources = {
+        'delay': args.delay,
+        'delayMs': int(args.delay * 1000),
+        'lines': args.huge * 1024,
+    }
+    extension = '.java' if args.lang == 'java' else '.py'
+
+    root = os.path.join(benchDir, 'root')
+    rows = []
+    counts = {}
+    picker = random.Random(args.seed)
+    for i in range(args.students):
+        kind = picker.choices(names, [weights[name] for name in names])[0]
+        counts[kind] = counts.get(kind, 0) + 1
+
+        id = 'b{:06d}'.format(i)
+        first = 'Student{:06d}'.format(i)
+        studentDir = os.path.join(root, 'Bench, {}({})'.format(first, id))
+        subDir = os.path.join(studentDir, SUBMISSION_DIR)
+        if kind in archetypes:
+            shutil.copytree(archetypes[kind], subDir)
+        else:
+            os.makedirs(subDir)
+            with open(os.path.join(subDir, 'Test' + extension), 'w') as file:
+                file.write(synthetic[kind].format(**sources))
+        with open(os.path.join(studentDir, 'timestamp.txt'), 'w') as file:
+            file.write('20180119194655746')
+        rows.append('V{:08d},{},Bench,{},0.0\n'.format(i, id, first))
+
+    with open(os.path.join(fixtureDir, 'root', 'grades.csv')) as file:
+        header = file.readlines()[:3]
+    with open(os.path.join(root, 'grades.csv'), 'w', newline = '\n') as file:
+        file.writelines(header + rows)
+
+    # The config file of the fixture, with the settings being measured.
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(fixtureDir, 'test.ini'))
+    config['Config']['root'] = 'root'
+    config['Config']['working'] = 'working'
+    config['Config']['batch'] = str(args.batch).lower()
+    config['Config']['lookahead'] = str(args.lookahead)
+    config['Config']['duplicates'] = str(args.duplicates).lower()
+    if args.workers:
+        config['Config']['workers'] = str(args.workers)
+    if 'Aux' in config and config['Aux'].get('files') == 'Test.txt':
+        config['Aux']['files'] = 'test.txt'
+
+    config['Run'] = {'timeout': str(args.timeout), 'output': str(args.output),
+            'backend': args.backend}
+    if args.processes:
+        config['Run']['processes'] = str(args.processes)
+    if args.cache:
+        config['Cache'] = {'size': str(args.cache)}
+    for option in args.set:
+        section, rest = option.split('.', 1)
+        key, value = rest.split('=', 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config[section][key] = value
+
+    configPath = os.path.join(benchDir, 'bench.ini')
+    with open(configPath, 'w') as file:
+        config.write(file)
+    return configPath, counts
+
+def peakMemory():
+    """
+    Gets the peak resident set size of this process and of its children.
+
+    Returns
+    -------
+        The peak sizes in KB, or None where they cannot be read.
+    """
+    if resource is None:
+        return {'self': None, 'children': None}
+
+    # Linux reports the sizes in KB, and macOS in bytes.
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        'children': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss // scale,
+    }
+
+def gitVersion():
+    """
+    Gets the commit the script is run from.
+
+    Returns
+    -------
+        The hash of the commit, or None if it is not in a git repository.
+    """
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                cwd = os.path.dirname(os.path.abspath(__file__)),
+                capture_output = True, text = True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+def runSession(configPath, tracePath, counter, quiet):
+    """
+    Runs a marking session the same way main does, tracing each stage.
+
+    Parameters
+    ----------
+    configPath:
+        The path to the config file.
+    tracePath:
+        The file the spans of the session are written to.
+    counter:
+        The FileOpCounter, which is enabled for the duration of the session.
+    quiet:
+        Whether the output of the marker is hidden.
+
+    Returns
+    -------
+        The wall time of the session, the number of students marked, and the
+        summary of the spans of each stage.
+    """
+    conf, marker, rubric = readConfigFile(configPath)
+    marker.editor = NullEditor()
+    useTracer(tracePath)
+
+    sink = open(os.devnull, 'w') if quiet else sys.stdout
+    counter.enabled = True
+    since = time.time()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(sink):
+            with traceSpan('mark'):
+                table = marker.mark(conf.root, rubric)
+
+            grades = GradeTable()
+            grades.index(table)
+            with traceSpan('export'), ThreadPoolExecutor(
+                    max_workers = 2) as pool:
+                exports = []
+                if conf.makeComments:
+                    exports.append(pool.submit(makeComments, grades,
+                        conf.root))
+                if conf.makeCSV:
+                    exports.append(pool.submit(makeCSV, grades, conf.root))
+                for export in exports:
+                    export.result()
+    finally:
+        wall = time.perf_counter() - start
+        counter.enabled = False
+        if quiet:
+            sink.close()
+
+    stages = utils.tracer.summary(since)
+    utils.tracer.close()
+    return wall, len(table), stages
+
+def compare(results, baselinePath):
+    """
+    Prints how the results changed from an earlier run.
+
+    Parameters
+    ----------
+    results:
+        The results of this run.
+    baselinePath:
+        The path to the JSON results of the earlier run.
+    """
+    with open(baselinePath) as file:
+        baseline = json.load(file)
+
+    print('Compared to {}:'.format(baseline.get('version') or baselinePath))
+    old = baseline['runs'][-1]
+    new = results['runs'][-1]
+    print('    submissions/sec: {:.2f} -> {:.2f} ({:+.1f}%)'.format(
+        old['rate'], new['rate'],
+        100 * (new['rate'] - old['rate']) / old['rate'] if old['rate'] else 0))
+    for stage, stats in sorted(new['stages'].items()):
+        if stage not in old['stages']:
+            continue
+        before = old['stages'][stage]['total']
+        after = stats['total']
+        print('    {}: {:.3f}s -> {:.3f}s'.format(stage, before, after))
+
+def main():
+    """
+    Main function of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description =
+            'Measures the throughput of the marking script.')
+    parser.add_argument('-l', '--lang', choices = sorted(SYNTHETIC),
+            default = 'python', help = 'The language of the fixtures.')
+    parser.add_argument('-n', '--students', type = int, default = 200,
+            help = 'The number of students in the class.')
+    parser.add_argument('--mix', default = '',
+            help = 'The weights of the archetypes, such as '
+            'errorr=1,slow=0.5,loop=0. The archetypes are the ids of the '
+            'fixture students, slow, loop, and huge.')
+    parser.add_argument('--seed', type = int, default = 0,
+            help = 'The seed used to pick the archetypes.')
+    parser.add_argument('--delay', type = float, default = 0.5,
+            help = 'The time in seconds the slow programs sleep for.')
+    parser.add_argument('--huge', type = int, default = 4,
+            help = 'The output in MB of the huge programs.')
+    parser.add_argument('--timeout', type = float, default = 2,
+            help = 'The timeout in seconds of each program.')
+    parser.add_argument('--output', type = int, default = 1024,
+            help = 'The output limit in KB of each program.')
+    parser.add_argument('--batch', action = 'store_true',
+            help = 'Run the submissions in batch mode.')
+    parser.add_argument('--workers', type = int, default = 0,
+            help = 'The number of processes used in batch mode.')
+    parser.add_argument('--lookahead', type = int, default = 0,
+            help = 'The number of submissions run ahead of the editor.')
+    parser.add_argument('--duplicates', action = 'store_true',
+            help = 'Run submissions with the same code once.')
+    parser.add_argument('--backend', choices = ['threads', 'async'],
+            default = 'threads', help = 'How programs are run.')
+    parser.add_argument('--processes', type = int, default = 0,
+            help = 'The number of programs the async backend runs at once.')
+    parser.add_argument('--cache', type = int, default = 0,
+            help = 'The size in MB of the result cache. If 0, there is no '
+            'cache.')
+    parser.add_argument('--set', action = 'append', default = [],
+            help = 'Any other setting, as Section.key=value.')
+    parser.add_argument('--runs', type = int, default = 1,
+            help = 'The number of sessions run on the same class. Later '
+            'sessions start from the manifest and cache of earlier ones.')
+    parser.add_argument('-o', '--json', default = '',
+            help = 'The file the results are saved to.')
+    parser.add_argument('--baseline', default = '',
+            help = 'Earlier results to compare against.')
+    parser.add_argument('--keep', action = 'store_true',
+            help = 'Keep the class once the benchmark is done.')
+    parser.add_argument('-v', '--verbose', action = 'store_true',
+            help = 'Show the output of the marker.')
+    args = parser.parse_args()
+
+    counter = FileOpCounter()
+    counter.install()
+
+    outputPath = os.path.abspath(args.json) if args.json else ''
+    baselinePath = os.path.abspath(args.baseline) if args.baseline else ''
+    benchDir = tempfile.mkdtemp(prefix = 'marking-bench-')
+    currDir = os.getcwd()
+    try:
+        setupStart = time.perf_counter()
+        configPath, counts = makeClass(args, benchDir)
+        print('Made a class of {} students in {:.2f}s: {}'.format(
+            args.students, time.perf_counter() - setupStart,
+            ', '.join('{} {}'.format(count, kind) for kind, count in
+                sorted(counts.items()))))
+
+        # Paths in the config file are relative to it, as they are for main.
+        os.chdir(benchDir)
+        runs = []
+        for i in range(args.runs):
+            # Each session marks the whole class again.
+            journalPath = os.path.join(benchDir, 'working', 'grades.journal')
+            if os.path.exists(journalPath):
+                os.remove(journalPath)
+
+            counter.counts = {}
+            wall, marked, stages = runSession(configPath, os.path.join(
+                benchDir, 'trace.jsonl'), counter, not args.verbose)
+            rate = marked / stages['mark']['total'] if marked else 0
+            runs.append({
+                'wall': wall,
+                'marked': marked,
+                'rate': rate,
+                'stages': stages,
+                'fileOps': dict(sorted(counter.counts.items())),
+                'memory': peakMemory(),
+            })
+
+            print('Run {}: marked {} students in {:.2f}s, {:.2f} '
+                    'submissions/sec'.format(i + 1, marked, wall, rate))
+            for stage, stats in stages.items():
+                print('    {}: {:.3f}s over {} spans, p50 {:.4f}s, '
+                        'p95 {:.4f}s'.format(stage, stats['total'],
+                            stats['count'], stats['p50'], stats['p95']))
+            print('    file operations: {}'.format(
+                sum(counter.counts.values())))
+            memory = runs[-1]['memory']
+            if memory['self'] is not None:
+                print('    peak RSS: {} KB, children {} KB'.format(
+                    memory['self'], memory['children']))
+    finally:
+        os.chdir(currDir)
+        if args.keep:
+            print('The class is kept in {}'.format(benchDir))
+        else:
+            shutil.rmtree(benchDir, ignore_errors = True)
+
+    results = {
+        'version': gitVersion(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': vars(args),
+        'class': counts,
+        'runs': runs,
+    }
+    if outputPath:
+        with open(outputPath, 'w') as file:
+            json.dump(results, file, indent = 2)
+    if baselinePath:
+        compare(results, baselinePath)
+
+if __name__ == '__main__':
+    main()
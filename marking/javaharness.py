@@ -0,0 +1,416 @@
+"""
+Module containing the warm JVM harness used by the Java marker.
+"""
+
+import os
+import signal
+import tempfile
+import threading
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+from utils import Process, Limits, CHUNK_SIZE
+from utils import STATUS_FINISHED, STATUS_TIMEOUT, STATUS_OUTPUT
+
+def buildHarness(compiler, harnessDir):
+    """
+    Compiles Harness.java into the given directory.
+
+    Parameters
+    ----------
+    compiler:
+        The Java compiler.
+    harnessDir:
+        The directory the harness is compiled into.
+
+    Returns
+    -------
+        True if the harness is ready to use, False otherwise.
+    """
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'Harness.java')
+    os.makedirs(harnessDir, exist_ok = True)
+
+    proc = Process()
+    proc.procName = compiler
+    proc.procArgs = ['-d', harnessDir, source]
+    procOut, procErr, procCode = proc.runPiped()
+    return procCode == 0
+
+class JavaHarness:
+    """
+    Runs Java programs inside warm JVMs instead of starting one per run.
+
+    Each worker is a JVM running Harness.java, which loads the program in a
+    fresh class loader and redirects System.in, System.out, and System.err to
+    files. Since the working directory of a JVM cannot change, workers are tied
+    to the directory of a single submission and are reused for every program
+    and test case run in it. If a worker cannot run a program the same way a
+    new JVM would (for example because the program calls System.exit), run
+    returns None and the program should be run in a new JVM instead.
+
+    Attributes
+    ----------
+    java:
+        The Java runtime.
+    compiler:
+        The Java compiler, used to build the harness itself.
+    harnessDir:
+        The directory the harness is compiled into.
+    limits:
+        The resource limits applied to each run. The CPU limit is not enforced
+        by the harness. The output limit is enforced as the program writes, by
+        ending the worker once it is reached.
+    workers:
+        The idle workers of each directory.
+    lock:
+        Guards the workers, since programs may be run from several threads.
+    """
+    def __init__(self):
+        self.java = 'java'
+        self.compiler = 'javac'
+        self.harnessDir = ''
+        self.limits = Limits()
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Leaves the workers out when the harness is sent to another process,
+        which starts its own.
+        """
+        state = self.__dict__.copy()
+        state['workers'] = {}
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def setup(self):
+        """
+        Compiles the harness into harnessDir.
+
+        Returns
+        -------
+            True if the harness is ready to use, False otherwise.
+        """
+        return buildHarness(self.compiler, self.harnessDir)
+
+    def start(self, workDir):
+        """
+        Starts a new worker in the given directory.
+
+        Parameters
+        ----------
+        workDir:
+            The directory the worker runs programs from.
+
+        Returns
+        -------
+            The Popen object of the worker.
+        """
+        args = [self.java]
+        if self.limits.memory:
+            args.append('-Xmx{}k'.format(self.limits.memory // 1024))
+        args += ['-cp', self.harnessDir, 'Harness']
+        return Popen(args, stdin = PIPE, stdout = PIPE, stderr = DEVNULL,
+                cwd = workDir, universal_newlines = True,
+                start_new_session = os.name == 'posix')
+
+    def kill(self, worker):
+        """
+        Kills a worker along with any process it started.
+
+        Parameters
+        ----------
+        worker:
+            The Popen object of the worker.
+        """
+        proc = Process()
+        proc.kill(worker)
+        worker.wait()
+
+    def run(self, workDir, classPath, name, inputFile, stdout, stderr):
+        """
+        Runs a program in a worker.
+
+        Parameters
+        ----------
+        workDir:
+            The directory the program is run from.
+        classPath:
+            The list of directories containing the classes of the program.
+        name:
+            The name of the main class.
+        inputFile:
+            The file used as stdin. If empty, the program gets no input.
+        stdout:
+            The object that receives the output of the program.
+        stderr:
+            The object that receives the error output of the program.
+
+        Returns
+        -------
+            The return code and status of the program, or None if it has to be
+            run in a new JVM.
+        """
+        with self.lock:
+            idle = self.workers.get(workDir, [])
+            worker = idle.pop() if idle else None
+        if worker is None:
+            worker = self.start(workDir)
+
+        outFd, outPath = tempfile.mkstemp(dir = workDir, suffix = '.out')
+        errFd, errPath = tempfile.mkstemp(dir = workDir, suffix = '.err')
+        os.close(outFd)
+        os.close(errFd)
+
+        timedOut = threading.Event()
+        def expire():
+            timedOut.set()
+            self.kill(worker)
+        timer = threading.Timer(self.limits.timeout, expire)
+        if self.limits.timeout:
+            timer.start()
+
+        try:
+            request = '\t'.join([os.pathsep.join(classPath), name,
+                os.path.abspath(inputFile) if inputFile else '', outPath,
+                errPath, str(self.limits.output)])
+            try:
+                worker.stdin.write(request + '\n')
+                worker.stdin.flush()
+                reply = worker.stdout.readline()
+            except OSError:
+                reply = ''
+            timer.cancel()
+
+            if timedOut.is_set():
+                self.collect(outPath, errPath, stdout, stderr)
+                return -getattr(signal, 'SIGKILL', 9), STATUS_TIMEOUT
+
+            # The worker ends itself once the program writes too much.
+            if reply.startswith('OUTPUT'):
+                self.kill(worker)
+                self.collect(outPath, errPath, stdout, stderr)
+                return -getattr(signal, 'SIGKILL', 9), STATUS_OUTPUT
+
+            if not reply.startswith('EXIT '):
+                self.kill(worker)
+                return None
+
+            with self.lock:
+                self.workers.setdefault(workDir, []).append(worker)
+
+            status = STATUS_FINISHED
+            if not self.collect(outPath, errPath, stdout, stderr):
+                status = STATUS_OUTPUT
+            return int(reply.split()[1]), status
+        finally:
+            timer.cancel()
+            os.remove(outPath)
+            os.remove(errPath)
+
+    def collect(self, outPath, errPath, stdout, stderr):
+        """
+        Passes the output files of a run to the sinks, within the output
+        limit.
+
+        Parameters
+        ----------
+        outPath:
+            The file holding the output of the program.
+        errPath:
+            The file holding the error output of the program.
+        stdout:
+            The object that receives the output.
+        stderr:
+            The object that receives the error output.
+
+        Returns
+        -------
+            False if the output went over the limit, True otherwise.
+        """
+        limit = self.limits.output
+        size = os.path.getsize(outPath) + os.path.getsize(errPath)
+        if not limit or size <= limit:
+            self.copy(outPath, stdout, 0)
+            self.copy(errPath, stderr, 0)
+            return True
+
+        written = self.copy(outPath, stdout, limit)
+        if written < limit:
+            self.copy(errPath, stderr, limit - written)
+        return False
+
+    def copy(self, path, sink, limit):
+        """
+        Streams the contents of a file into a sink in chunks.
+
+        Parameters
+        ----------
+        path:
+            The file to read.
+        sink:
+            The object that receives the chunks.
+        limit:
+            The number of bytes to copy at most. If 0, the whole file is
+            copied.
+
+        Returns
+        -------
+            The number of bytes copied.
+        """
+        copied = 0
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                if limit and copied + len(chunk) > limit:
+                    chunk = chunk[:limit - copied]
+                sink.write(chunk)
+                copied += len(chunk)
+                if limit and copied >= limit:
+                    break
+        return copied
+
+    def close(self, workDir):
+        """
+        Stops the idle workers of a directory.
+
+        Parameters
+        ----------
+        workDir:
+            The directory whose workers are stopped.
+        """
+        with self.lock:
+            idle = self.workers.pop(workDir, [])
+        for worker in idle:
+            try:
+                worker.stdin.close()
+            except OSError:
+                pass
+            try:
+                worker.wait(timeout = 1)
+            except TimeoutExpired:
+                self.kill(worker)
+
+class JavaCompileServer:
+    """
+    Compiles Java sources inside warm JVMs instead of starting javac for each
+    submission.
+
+    Each worker is a JVM running Harness.java in compile mode, which calls the
+    compiler of the JVM through javax.tools. Since all paths are passed to the
+    worker, workers are shared by every submission. The diagnostics have the
+    same format as the ones printed by javac.
+
+    Attributes
+    ----------
+    java:
+        The Java runtime.
+    compiler:
+        The Java compiler, used to build the harness itself.
+    harnessDir:
+        The directory the harness is compiled into.
+    workers:
+        The idle workers.
+    lock:
+        Guards the workers, since submissions may be compiled from several
+        threads.
+    """
+    def __init__(self):
+        self.java = 'java'
+        self.compiler = 'javac'
+        self.harnessDir = ''
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Leaves the workers out when the server is sent to another process,
+        which starts its own.
+        """
+        state = self.__dict__.copy()
+        state['workers'] = []
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def setup(self):
+        """
+        Compiles the harness into harnessDir.
+
+        Returns
+        -------
+            True if the server is ready to use, False otherwise.
+        """
+        return buildHarness(self.compiler, self.harnessDir)
+
+    def compile(self, sources, outDir, classPath):
+        """
+        Compiles a set of sources in a worker.
+
+        Parameters
+        ----------
+        sources:
+            The list of source files to compile.
+        outDir:
+            The directory the classes are written to.
+        classPath:
+            The list of directories holding the classes the sources use.
+
+        Returns
+        -------
+            The return code and diagnostics of the compiler, or None if the
+            worker failed and the sources have to be compiled with javac.
+        """
+        with self.lock:
+            worker = self.workers.pop() if self.workers else None
+        if worker is None:
+            worker = Popen([self.java, '-cp', self.harnessDir, 'Harness',
+                'compile'], stdin = PIPE, stdout = PIPE, stderr = DEVNULL,
+                universal_newlines = True)
+
+        diagFd, diagPath = tempfile.mkstemp(suffix = '.diag')
+        os.close(diagFd)
+        try:
+            request = '\t'.join([os.path.abspath(outDir),
+                os.pathsep.join(os.path.abspath(path) for path in classPath),
+                diagPath] + [os.path.abspath(source) for source in sources])
+            try:
+                worker.stdin.write(request + '\n')
+                worker.stdin.flush()
+                reply = worker.stdout.readline()
+            except OSError:
+                reply = ''
+
+            if not reply.startswith('DONE '):
+                worker.kill()
+                worker.wait()
+                return None
+
+            with self.lock:
+                self.workers.append(worker)
+            with open(diagPath, encoding = 'utf-8', errors = 'replace') as file:
+                return int(reply.split()[1]), file.read()
+        finally:
+            os.remove(diagPath)
+
+    def close(self):
+        """
+        Stops the idle workers.
+        """
+        with self.lock:
+            idle, self.workers = self.workers, []
+        for worker in idle:
+            try:
+                worker.stdin.close()
+            except OSError:
+                pass
+            try:
+                worker.wait(timeout = 1)
+            except TimeoutExpired:
+                worker.kill()
+                worker.wait()
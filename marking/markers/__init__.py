@@ -0,0 +1,55 @@
+"""
+The language markers.
+
+Markers are found by the name of their language, as given in the Language
+section of the config file. Only the marker of that language is imported. Other
+packages can add markers by registering a subclass of Marker under the
+'marking.markers' entry point group, with the name of the language as the name
+of the entry point.
+"""
+
+import importlib
+
+# The markers that ship with the script, as the module and the name of the
+# class.
+BUILTIN_MARKERS = {
+    'java': ('markers.javamarker', 'JavaMarker'),
+    'python': ('markers.pythonmarker', 'PythonMarker'),
+}
+
+ENTRY_POINT_GROUP = 'marking.markers'
+
+def findMarker(language):
+    """
+    Finds the marker of a language, importing it only now.
+
+    Parameters
+    ----------
+    language:
+        The name of the language.
+
+    Returns
+    -------
+        The marker class, or None if no marker handles the language.
+    """
+    if language in BUILTIN_MARKERS:
+        module, name = BUILTIN_MARKERS[language]
+        return getattr(importlib.import_module(module), name)
+
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return None
+
+    # Entry points are grouped with select since Python 3.10, and in a dict
+    # before that.
+    points = entry_points()
+    if hasattr(points, 'select'):
+        points = points.select(group = ENTRY_POINT_GROUP)
+    else:
+        points = points.get(ENTRY_POINT_GROUP, [])
+
+    for point in points:
+        if point.name == language:
+            return point.load()
+    return None
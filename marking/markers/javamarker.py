@@ -0,0 +1,505 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from os.path import basename
+from copy import copy
+from utils import Process, digestFile, traceSpan
+from markers.marker import Marker
+
+class JavaMarker(Marker):
+    """
+    The marker script for Java submissions.
+
+    Attributes:
+    ----------
+    generatedExtension:
+        The extension that Java generates when it compiles.
+    compiler:
+        The Java compiler.
+    runArgs:
+        The arguments when invoking the program.
+    harness:
+        The JavaHarness used to run programs in warm JVMs. If None, every
+        program is run in a new JVM.
+    batchCompile:
+        Whether all the files of a submission are compiled with a single
+        compiler invocation instead of one per file.
+    compileServer:
+        The JavaCompileServer used to compile submissions in warm JVMs. If
+        set, files are compiled in batches regardless of batchCompile.
+    auxClassDir:
+        The directory holding the classes of the auxiliary Java files, which
+        are compiled once per session and put on the class path instead of
+        being copied to every submission. If empty, the auxiliary files are
+        compiled along with each submission.
+    """
+
+    DIAGNOSTIC = re.compile(r'^(.+?\.java):\d+: ')
+    DIAGNOSTIC_END = re.compile(r'^(\d+ (errors?|warnings?)|Note: .*)$')
+    JAVA_TOKEN = re.compile(r'''
+        (?P<comment>//[^\n]*|/\*.*?\*/)
+        | (?P<literal>"""(?:\\.|[^\\])*?"""
+            | "(?:\\.|[^"\\\n])*" | '(?:\\.|[^'\\\n])*')
+        | (?P<word>[\w$]+)
+        | (?P<space>\s+)
+        | (?P<other>.)''', re.S | re.X)
+
+    def __init__(self):
+        super().__init__()
+        self.extension = '.java'
+        self.generatedExtension = '.class'
+        self.compiler = 'javac'
+        self.run = 'java'
+        self.runArgs = []
+        self.harness = None
+        self.batchCompile = False
+        self.compileServer = None
+        self.auxClassDir = ''
+
+    def configure(self, config):
+        """
+        Reads the Java section of the config file.
+
+        Parameters:
+        ----------
+        config:
+            The parsed config file.
+
+        Returns:
+        -------
+            False if the settings are not valid, True otherwise.
+        """
+        if not config.has_section('Java'):
+            return True
+
+        # The harness is only loaded when one of its modes is used.
+        if config.has_option('Java', 'harness'):
+            if config['Java'].getboolean('harness'):
+                from javaharness import JavaHarness
+                self.harness = JavaHarness()
+
+        if config.has_option('Java', 'compile'):
+            mode = config['Java']['compile'].lower()
+            if mode == 'batch':
+                self.batchCompile = True
+            elif mode == 'server':
+                from javaharness import JavaCompileServer
+                self.compileServer = JavaCompileServer()
+            elif mode != 'file':
+                print('Error: unknown compile mode {}.'.format(mode))
+                return False
+        return True
+
+    def classPath(self, workDir):
+        """
+        Gets the class path of the programs of a submission.
+
+        Parameters:
+        ----------
+        workDir:
+            The directory of the submission.
+
+        Returns:
+        -------
+            The list of directories holding the classes of the programs.
+        """
+        if self.auxClassDir:
+            return [workDir, self.auxClassDir]
+        return [workDir]
+
+    def classPathArgs(self):
+        """
+        Gets the arguments that give the class path to the compiler and the
+        runtime, which are run from the directory of the submission.
+
+        Returns:
+        -------
+            The list of arguments. If there are no auxiliary classes, the
+            default class path is used and the list is empty.
+        """
+        if self.auxClassDir:
+            return ['-cp', os.pathsep.join(['.', self.auxClassDir])]
+        return []
+
+    def auxSources(self):
+        """
+        Gets the auxiliary files that are Java sources.
+
+        Returns:
+        -------
+            The list of sources.
+        """
+        return [file for file in self.auxFiles if
+                file.endswith(self.extension)]
+
+    def compileAuxFiles(self):
+        """
+        Compiles the auxiliary Java files into a directory in the cache, named
+        after the hash of the sources, so they are only compiled again when
+        they change.
+
+        Returns:
+        -------
+            The directory holding the classes, or an empty string if the
+            sources could not be compiled.
+        """
+        sources = self.auxSources()
+        hash = hashlib.sha256(self.compiler.encode())
+        for source in sorted(sources, key = basename):
+            hash.update(basename(source).encode() + b'\0')
+            hash.update(digestFile(source).encode())
+
+        classesDir = os.path.join(self.workingDir, 'cache', 'classes')
+        classDir = os.path.abspath(os.path.join(classesDir,
+            hash.hexdigest()[:16]))
+        if os.path.isdir(classDir):
+            return classDir
+
+        # Classes are compiled next to their final directory and only moved
+        # there once they are all written.
+        os.makedirs(classesDir, exist_ok = True)
+        tempDir = tempfile.mkdtemp(dir = classesDir)
+        compileProc = Process()
+        compileProc.procName = self.compiler
+        compileProc.procArgs = ['-d', tempDir] + [os.path.abspath(source) for
+                source in sources]
+        compileOut, compileErr, compileCode = compileProc.runPiped()
+        if compileCode != 0:
+            shutil.rmtree(tempDir, ignore_errors = True)
+            print('Error: could not compile the auxiliary files. They will be '
+                    'compiled with every submission.')
+            print(self.convertByteString(compileErr))
+            return ''
+
+        try:
+            os.rename(tempDir, classDir)
+        except OSError:
+            # Another session got there first.
+            shutil.rmtree(tempDir, ignore_errors = True)
+        return classDir
+
+    def stagedAuxFiles(self):
+        """
+        Gets the auxiliary files that are copied into the sandbox of every
+        submission. Sources that were compiled for the session are left out,
+        since their classes are on the class path.
+
+        Returns:
+        -------
+            The list of auxiliary files.
+        """
+        if not self.auxClassDir:
+            return self.auxFiles
+        return [file for file in self.auxFiles if not
+                file.endswith(self.extension)]
+
+    def compileFile(self, name, workDir):
+        """
+        Compiles the given file.
+
+        Parameters:
+        ----------
+        name:
+            The name of the file to compile.
+        workDir:
+            The directory containing the file.
+
+        Returns:
+        -------
+            The stdout, stderr, and return code of the compiler.
+        """
+        compileProc = Process()
+        compileProc.procName = self.compiler
+        compileProc.procArgs = self.classPathArgs() + [name]
+        compileProc.workingDir = workDir
+        compileOut, compileErr, compileCode = compileProc.runPiped()
+
+        compileOut = self.convertByteString(compileOut)
+        compileErr = self.convertByteString(compileErr)
+
+        return compileCode, compileErr, compileOut
+
+    def compileSources(self, sources, workDir):
+        """
+        Compiles the source files of a submission, either one at a time or all
+        together.
+
+        Parameters:
+        ----------
+        sources:
+            The names of the files to compile.
+        workDir:
+            The directory containing the files.
+
+        Returns:
+        -------
+            A dictionary with the return code, stderr, and stdout of the
+            compiler for each file.
+        """
+        with traceSpan('compile', files = len(sources)):
+            if self.batchCompile or self.compileServer is not None:
+                return self.compileSubmission(sources, workDir)
+            return {source: self.compileFile(source, workDir) for source in
+                    sources}
+
+    def compileSubmission(self, sources, workDir):
+        """
+        Compiles all the given files together, then splits the diagnostics of
+        the compiler by file.
+
+        Parameters:
+        ----------
+        sources:
+            The names of the files to compile.
+        workDir:
+            The directory containing the files.
+
+        Returns:
+        -------
+            A dictionary with the return code, stderr, and stdout of the
+            compiler for each file, as returned by compileFile.
+        """
+        result = None
+        if self.compileServer is not None:
+            result = self.compileServer.compile(
+                    [os.path.join(workDir, source) for source in sources],
+                    workDir, self.classPath(workDir))
+
+        if result is not None:
+            compileCode, compileErr = result
+            compileOut = ''
+        else:
+            compileProc = Process()
+            compileProc.procName = self.compiler
+            compileProc.procArgs = self.classPathArgs() + sources
+            compileProc.workingDir = workDir
+            compileOut, compileErr, compileCode = compileProc.runPiped()
+            compileOut = self.convertByteString(compileOut)
+            compileErr = self.convertByteString(compileErr)
+
+        if compileCode == 0:
+            return {source: (0, '', '') for source in sources}
+
+        diagnostics = self.splitDiagnostics(compileErr, sources)
+        results = {}
+        for source in sources:
+            errors = diagnostics[source]
+            if errors:
+                results[source] = (compileCode, errors, compileOut)
+                continue
+
+            # The file itself is fine, but it only counts as compiled if the
+            # compiler got as far as writing its class.
+            name = source[:-len(self.extension)]
+            if os.path.exists(os.path.join(workDir,
+                name + self.generatedExtension)):
+                results[source] = (0, '', '')
+            else:
+                results[source] = (compileCode,
+                        'Other files of the submission failed to compile:\n'
+                        + compileErr, compileOut)
+        return results
+
+    def splitDiagnostics(self, output, sources):
+        """
+        Splits the diagnostics of the compiler by the file they refer to.
+
+        Each diagnostic starts with a line of the form "File.java:line: " and
+        runs until the next one. Lines outside of any diagnostic, such as the
+        error count, are left out.
+
+        Parameters:
+        ----------
+        output:
+            The diagnostics printed by the compiler.
+        sources:
+            The names of the files that were compiled.
+
+        Returns:
+        -------
+            A dictionary with the diagnostics of each file.
+        """
+        names = {basename(source): source for source in sources}
+        diagnostics = {source: [] for source in sources}
+        current = None
+        for line in output.splitlines(True):
+            match = self.DIAGNOSTIC.match(line)
+            if match:
+                current = names.get(basename(match.group(1)))
+            elif self.DIAGNOSTIC_END.match(line.rstrip()):
+                current = None
+                continue
+
+            if current is not None:
+                diagnostics[current].append(line)
+
+        return {source: ''.join(lines) for source, lines in
+                diagnostics.items()}
+
+    def programName(self, entry):
+        """
+        Gets the name of the class compiled from a source file.
+
+        Parameters:
+        ----------
+        entry:
+            The name of the source file.
+
+        Returns:
+        -------
+            The name of the class.
+        """
+        return entry[:-len(self.extension)]
+
+    def makeRunProcess(self, name, workDir):
+        """
+        Sets up the JVM that runs a program.
+
+        Parameters:
+        ----------
+        name:
+            The name of the main class.
+        workDir:
+            The directory the program is run from.
+
+        Returns:
+        -------
+            The Process to run.
+        """
+        runProc = super().makeRunProcess(name, workDir)
+        runProc.procArgs = self.classPathArgs() + [name]
+
+        # The JVM reserves far more address space than it uses, so the memory
+        # limit is given to it as the maximum heap size instead.
+        if self.limits.memory:
+            runProc.limits = copy(self.limits)
+            runProc.limits.memory = 0
+            runProc.procArgs = ['-Xmx{}k'.format(self.limits.memory // 1024)
+                    ] + runProc.procArgs
+        return runProc
+
+    def runWarm(self, name, workDir, inputFile, runOut, runErr):
+        """
+        Runs a program in a warm JVM of the harness, if there is one.
+
+        Parameters:
+        ----------
+        name:
+            The name of the main class.
+        workDir:
+            The directory the program is run from.
+        inputFile:
+            The file used as stdin. If empty, the program gets no input.
+        runOut:
+            The Capture that receives the output of the program.
+        runErr:
+            The Capture that receives the error output of the program.
+
+        Returns:
+        -------
+            The return code and status of the program, or None if it has to be
+            run in a new JVM.
+        """
+        if self.harness is None:
+            return None
+        return self.harness.run(workDir, self.classPath(workDir), name,
+                inputFile, runOut, runErr)
+
+    def finishSubmission(self, workDir):
+        """
+        Stops the warm JVMs of a submission.
+
+        Parameters:
+        ----------
+        workDir:
+            The directory of the submission.
+        """
+        if self.harness is not None:
+            self.harness.close(workDir)
+
+    def normalizeSource(self, text):
+        """
+        Strips the comments and whitespace from Java source code.
+
+        Parameters:
+        ----------
+        text:
+            The source code.
+
+        Returns:
+        -------
+            The tokens of the code, one per line.
+        """
+        tokens = []
+        for match in self.JAVA_TOKEN.finditer(text):
+            if match.lastgroup in ('comment', 'space'):
+                continue
+            tokens.append(match.group())
+        return '\n'.join(tokens)
+
+    def toolchainVersion(self):
+        """
+        Gets the version of the Java compiler and runtime.
+
+        Returns:
+        -------
+            The version strings printed by the compiler and the runtime.
+        """
+        versions = []
+        for program in (self.compiler, self.run):
+            proc = Process()
+            proc.procName = program
+            proc.procArgs = ['-version']
+            procOut, procErr, procCode = proc.runPiped()
+            versions.append(self.convertByteString(procOut + procErr))
+        return '\n'.join(versions)
+
+    def cacheSettings(self):
+        """
+        Gets the marker settings that change the results of a run, including
+        how the programs are compiled and run.
+
+        Returns:
+        -------
+            The list of settings, which are part of the salt of the cache.
+        """
+        return super().cacheSettings() + [self.runArgs, self.batchCompile,
+                self.compileServer is not None, self.harness is not None]
+
+    def setup(self):
+        """
+        Compiles the auxiliary files and builds the harness used by the warm
+        JVMs and the compile server.
+        """
+        if self.auxSources():
+            self.auxClassDir = self.compileAuxFiles()
+
+        if self.harness is not None:
+            self.harness.java = self.run
+            self.harness.compiler = self.compiler
+            self.harness.harnessDir = os.path.join(self.workingDir, 'harness')
+            self.harness.limits = self.limits
+            if not self.harness.setup():
+                print('Error: could not compile the harness. Programs will '
+                        'be run in new JVMs.')
+                self.harness = None
+
+        if self.compileServer is not None:
+            self.compileServer.java = self.run
+            self.compileServer.compiler = self.compiler
+            self.compileServer.harnessDir = os.path.join(self.workingDir,
+                    'harness')
+            if not self.compileServer.setup():
+                print('Error: could not compile the harness. Submissions '
+                        'will be compiled with {}.'.format(self.compiler))
+                self.compileServer = None
+                self.batchCompile = True
+
+    def teardown(self):
+        """
+        Stops the compile server.
+        """
+        if self.compileServer is not None:
+            self.compileServer.close()
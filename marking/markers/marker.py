@@ -0,0 +1,1301 @@
+import json
+import os
+import posixpath
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+from os.path import basename
+from utils import Editor, Rubric, Process, Sandbox, Limits, Capture
+from utils import Comparator, TestResult
+from utils import STATUS_FINISHED
+from utils import hashSubmission, GradeJournal, Manifest, digestFile
+from utils import SUBMISSION_DIR
+from utils import traceSpan, formatDuration
+
+# The files a run leaves in the sandbox besides the output of the programs.
+RESULT_FILES = ['summary.txt', 'outcomes.json']
+
+class Marker:
+    """
+    The base class of the language markers.
+
+    The marker takes care of staging, running, and diffing the submissions,
+    and of handing them to the editor. Languages only fill in the steps that
+    differ between them: compileSources for compiled languages, programName and
+    makeRunProcess for how a program is started, and normalizeSource for how
+    duplicate submissions are found.
+
+    Attributes:
+    ----------
+    extension:
+        The extension of the source files.
+    run:
+        The program used to run the submissions.
+    editor:
+        An instance of the Editor class.
+    inputFiles:
+        The list of input files for the assignment.
+    outputFiles:
+        The list of output files for the assignment.
+    diff:
+        Whether to perform the diff or not.
+    comparator:
+        The Comparator used to perform the diff.
+    tests:
+        The test cases of each program, as found by findTestCases. Programs
+        with test cases are run once per test case instead of once with the
+        input and output files.
+    maxFailures:
+        The number of failed test cases after which the remaining test cases
+        of a program are not run. If 0, all test cases are run.
+    workingDir:
+        The directory where we copy all of the files.
+    preProcessScript:
+        The script that needs to be run before the assignment is run.
+    auxFiles:
+        The list of auxiliary files.
+    batch:
+        Whether all submissions are run before the marking starts.
+    workers:
+        The number of processes used to run submissions in batch mode.
+    lookahead:
+        The number of upcoming submissions that are run in the background
+        while the current one is being marked.
+    limits:
+        The resource limits applied when running the submissions.
+    headSize:
+        The number of bytes kept from the start of the output of a program.
+        If this or tailSize is set, the full output is spilled to disk.
+    tailSize:
+        The number of bytes kept from the end of the output of a program.
+    archive:
+        The Archive of the root, if the root is a zip archive. If None, the
+        root is a directory.
+    journal:
+        The GradeJournal of the students marked so far.
+    cache:
+        The ResultCache holding the results of earlier sessions. If None,
+        every submission is run.
+    duplicates:
+        Whether submissions with the same code are run only once.
+    autoGrader:
+        The AutoGrader that marks students from the outcomes of their programs.
+        If None, every student is marked in the editor.
+    queue:
+        The WorkQueue shared with other markers of the same class. If None,
+        this marker marks every student.
+    """
+
+    def __init__(self):
+        self.extension = ''
+        self.run = ''
+        self.editor = Editor()
+        self.inputFiles = ''
+        self.outputFiles = ''
+        self.diff = False
+        self.comparator = Comparator()
+        self.tests = {}
+        self.maxFailures = 0
+        self.workingDir = ''
+        self.preProcessScript = ''
+        self.auxFiles = []
+        self.batch = False
+        self.workers = os.cpu_count()
+        self.lookahead = 0
+        self.limits = Limits()
+        self.headSize = 0
+        self.tailSize = 0
+        self.archive = None
+        self.journal = GradeJournal()
+        self.cache = None
+        self.duplicates = False
+        self.autoGrader = None
+        self.queue = None
+
+    def configure(self, config):
+        """
+        Reads the settings of the language from the config file.
+
+        Parameters:
+        ----------
+        config:
+            The parsed config file.
+
+        Returns:
+        -------
+            False if the settings are not valid, True otherwise.
+        """
+        return True
+
+    def convertByteString(self, bytes):
+        """
+        Decodes the given byte string into a regular string.
+
+        Parameters:
+        ---------
+        bytes:
+            The byte string to be decoded.
+
+        Returns:
+        -------
+            The decoded string (if possible)
+        """
+        decoded = False
+
+        # Try to decode as utf-8
+        try:
+            bytes = bytes.decode('utf-8', 'backslashreplace')
+            decoded = True
+        except:
+            pass
+
+        if decoded:
+            bytes = bytes.replace('\r\n', '\n')
+
+        return bytes
+
+    def compileSources(self, sources, workDir):
+        """
+        Compiles the source files of a submission.
+
+        Parameters:
+        ----------
+        sources:
+            The names of the files to compile.
+        workDir:
+            The directory containing the files.
+
+        Returns:
+        -------
+            A dictionary with the return code, stderr, and stdout of the
+            compiler for each file, or None if the language is not compiled.
+            Markers that compile record the time it takes as a compile span.
+        """
+        return None
+
+    def programName(self, entry):
+        """
+        Gets the name the program of a source file is run by.
+
+        Parameters:
+        ----------
+        entry:
+            The name of the source file.
+
+        Returns:
+        -------
+            The name of the program.
+        """
+        return entry
+
+    def makeRunProcess(self, name, workDir):
+        """
+        Sets up the process that runs a program.
+
+        Parameters:
+        ----------
+        name:
+            The name of the program.
+        workDir:
+            The directory the program is run from.
+
+        Returns:
+        -------
+            The Process to run.
+        """
+        runProc = Process()
+        runProc.procName = self.run
+        runProc.procArgs = [name]
+        runProc.workingDir = workDir
+        runProc.limits = self.limits
+        runProc.student = True
+        return runProc
+
+    def runWarm(self, name, workDir, inputFile, runOut, runErr):
+        """
+        Runs a program without starting a new process for it, if the language
+        has a way to do so.
+
+        Parameters:
+        ----------
+        name:
+            The name of the program.
+        workDir:
+            The directory the program is run from.
+        inputFile:
+            The file used as stdin. If empty, the program gets no input.
+        runOut:
+            The Capture that receives the output of the program.
+        runErr:
+            The Capture that receives the error output of the program.
+
+        Returns:
+        -------
+            The return code and status of the program, or None if it has to be
+            run in a new process.
+        """
+        return None
+
+    def runFile(self, name, workDir, test = None):
+        """
+        Runs the program.
+
+        This will also capture stdout, stderr, and use any input files as
+        stdin.
+
+        Parameters:
+        ----------
+        name:
+            The name of the program to run.
+        workDir:
+            The directory the program is run from.
+        test:
+            The TestCase to take the input from. If None, the input file with
+            the same name as the program is used.
+
+        Returns:
+        -------
+            The stdout, stderr, return code, and status of the program. The
+            output is returned as Capture objects, which must be closed.
+        """
+        runProc = self.makeRunProcess(name, workDir)
+
+        # Check if there is an input file that needs to be used.
+        inputFile = ''
+        if test is not None:
+            inputFile = test.input
+        else:
+            for file in self.inputFiles:
+                fName = os.path.splitext(basename(file))[0]
+                if fName == os.path.splitext(name)[0]:
+                    inputFile = file
+                    break
+
+        runOut = Capture(self.headSize, self.tailSize, workDir)
+        runErr = Capture(self.headSize, self.tailSize, workDir)
+
+        with traceSpan('run', program = name):
+            # If the program can't be run warm, nothing has been captured and
+            # we fall through.
+            result = self.runWarm(name, workDir, inputFile, runOut, runErr)
+            if result is not None:
+                runCode, runStatus = result
+                return runCode, runErr, runOut, runStatus
+
+            if inputFile:
+                with open(inputFile, 'r') as inFile:
+                    inLines = inFile.read()
+                    inLines = str.encode(inLines)
+                    runCode = runProc.execute(runOut, runErr, input = inLines)
+            else:
+                runCode = runProc.execute(runOut, runErr)
+
+        return runCode, runErr, runOut, runProc.status
+
+    def performDiff(self, expected, ans):
+        """
+        Performs the diff between the student's output and the master output.
+
+        Parameters:
+        ----------
+        expected:
+            The path to the master output to compare against.
+        ans:
+            The Capture holding the students answer.
+
+        Returns:
+        -------
+            0 if the diff fails, 1 otherwise. It will also return the results of
+            the diff.
+
+        """
+        with traceSpan('diff', output = basename(expected)):
+            return self.comparator.compare(expected, ans)
+
+    def runTest(self, name, workDir, test):
+        """
+        Runs the program on a single test case and checks its output.
+
+        Parameters:
+        ----------
+        name:
+            The name of the program to run.
+        workDir:
+            The directory the program is run from.
+        test:
+            The TestCase to run.
+
+        Returns:
+        -------
+            The TestResult of the test case.
+        """
+        runCode, runErr, runOut, runStatus = self.runFile(name, workDir, test)
+
+        result = TestResult()
+        result.test = test
+        result.ran = True
+        result.code = runCode
+        result.status = runStatus
+        if runCode == 0 and runStatus == STATUS_FINISHED:
+            if test.output:
+                result.diffCode, result.diff = self.performDiff(test.output,
+                        runOut)
+        else:
+            result.stdout = str(runOut)
+            result.stderr = str(runErr)
+
+        runOut.close()
+        runErr.close()
+        return result
+
+    def runTests(self, name, workDir, tests):
+        """
+        Runs the program on all of its test cases at the same time.
+
+        The test cases share the directory of the submission. Only as many test
+        cases as there are workers are started at once, and once maxFailures
+        test cases have failed, the ones that have not started are skipped.
+
+        Parameters:
+        ----------
+        name:
+            The name of the program to run.
+        workDir:
+            The directory the program is run from.
+        tests:
+            The list of TestCase to run.
+
+        Returns:
+        -------
+            The list of TestResult, in the same order as the test cases.
+        """
+        results = []
+        for test in tests:
+            result = TestResult()
+            result.test = test
+            results.append(result)
+
+        failures = 0
+        workers = min(len(tests), os.cpu_count() or 1)
+        upcoming = iter(enumerate(tests))
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            running = {}
+            while True:
+                # A test case is only started while more failures are allowed,
+                # since running ones cannot be stopped.
+                while len(running) < workers and not (self.maxFailures and
+                        failures >= self.maxFailures):
+                    case = next(upcoming, None)
+                    if case is None:
+                        break
+                    i, test = case
+                    running[pool.submit(self.runTest, name, workDir, test)] = i
+
+                if not running:
+                    break
+
+                done, pending = wait(running, return_when = FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results[running.pop(future)] = result
+                    if not result.passed():
+                        failures += 1
+
+        return results
+
+    def writeTestResults(self, sFile, results):
+        """
+        Writes the results of the test cases of a program to the summary.
+
+        Parameters:
+        ----------
+        sFile:
+            The summary file.
+        results:
+            The list of TestResult of the program.
+        """
+        for result in results:
+            sFile.write(result.describe(self.limits))
+        passed = len([result for result in results if result.passed()])
+        sFile.write('Passed {} of {} test cases.\n\n'.format(passed,
+            len(results)))
+
+    def finishSubmission(self, workDir):
+        """
+        Releases anything held for a submission once all of its programs have
+        been run.
+
+        Parameters:
+        ----------
+        workDir:
+            The directory of the submission.
+        """
+        pass
+
+    def runSubmission(self, submission):
+        """
+        Compiles and runs the student submission.
+
+        Parameters:
+        ----------
+        submission:
+            The student submission bundle. The first element is the directory
+            the submission was copied to, and the last is the list of files
+            that make up the submission.
+
+        Returns:
+            The list of files for the editor. The outcome of each program is
+            written to outcomes.json.
+        """
+        workDir = submission[0]
+        summaryFile = os.path.join(workDir, 'summary.txt')
+        fileList = []
+        outcomes = {}
+
+        sources = [entry for entry in submission[-1] if self.extension in
+                entry]
+        compiled = None
+        if sources:
+            compiled = self.compileSources(sources, workDir)
+
+        for entry in sources:
+            fileList.append(entry)
+
+            compileCode = 0
+            if compiled is not None:
+                compileCode, compileErr, compileOut = compiled[entry]
+
+            tests = []
+            if compileCode == 0:
+                name = self.programName(entry)
+                tests = self.tests.get(os.path.splitext(entry)[0].lower(), [])
+
+            if tests:
+                testResults = self.runTests(name, workDir, tests)
+            elif compileCode is 0:
+                runCode, runErr, runOut, runStatus = self.runFile(
+                        name, workDir)
+
+                diffResult = []
+                diffCode = -1
+                if runCode is 0 and self.diff:
+                    # First load in the output file.
+                    outFile = ''
+                    for file in self.outputFiles:
+                        fName = os.path.splitext(basename(file))[0]
+                        sName = os.path.splitext(basename(entry))[0]
+                        if fName.lower() == sName.lower():
+                            outFile = file
+                            break
+
+                    if outFile:
+                        diffCode, diffResult = self.performDiff(outFile,
+                                runOut)
+
+            # Keep what happened to the program for automatic marking.
+            outcome = {'compiled': compileCode == 0, 'runs': []}
+            if tests:
+                for result in testResults:
+                    outcome['runs'].append({'test': result.test.name,
+                        'ran': result.ran, 'status': result.status,
+                        'code': result.code, 'diff': result.diffCode})
+            elif compileCode == 0:
+                outcome['runs'].append({'test': '', 'ran': True,
+                    'status': runStatus, 'code': runCode, 'diff': diffCode})
+            outcomes[os.path.splitext(entry)[0].lower()] = outcome
+
+            if os.path.exists(summaryFile):
+                mode = 'a'
+            else:
+                mode = 'w'
+
+            with traceSpan('summary', file = entry), open(summaryFile, mode,
+                    newline = '\n', encoding = 'utf-8') as sFile:
+                sFile.write('#=========================================#\n')
+                sFile.write('# Summary for file {}\n'.format(entry))
+                sFile.write('#=========================================#\n')
+
+                if compileCode is not 0:
+                    sFile.write('Compilation error: return code {}\n'.format(
+                        compileCode))
+                    sFile.write('{}\n\n'.format(compileErr))
+                    sFile.write('{}\n\n'.format(compileOut))
+                elif tests:
+                    if compiled is not None:
+                        sFile.write('Compilation successful\n')
+                    self.writeTestResults(sFile, testResults)
+                else:
+                    if compiled is not None:
+                        sFile.write('Compilation successful\n')
+                    if runStatus != STATUS_FINISHED:
+                        sFile.write('{}\n\n'.format(
+                            self.limits.describe(runStatus)))
+                    else:
+                        sFile.write('Program return code: {}\n\n'.format(
+                            runCode))
+
+                    if runCode is 0:
+                        if self.diff:
+                            if diffCode is 1:
+                                sFile.write(
+                                    'Diff results: outputs are identical.\n\n')
+                            elif diffCode is -1:
+                                sFile.write('Could not perform diff.\n\n')
+                            else:
+                                if len(diffResult) == 0:
+                                    sFile.write('Diff results\n')
+                                    sFile.write('Empty diff. No output received from program.')
+                                else:
+                                    sFile.write('Diff results:\n')
+                                    sFile.write('Legend:\n')
+                                    sFile.write('-: expected\n')
+                                    sFile.write('+: received\n')
+                                    sFile.write('?: diff results\n\n')
+                                    sFile.writelines(diffResult)
+                                    sFile.write('\n')
+                        else:
+                            sFile.write('# Output for {}\n'.format(
+                                entry))
+                            sFile.write('#=============================#\n')
+                            sFile.write('stdout:\n{}\n\n'.format(runOut))
+                            sFile.write('#=============================#\n')
+                            sFile.write('stderr:\n{}\n\n'.format(runErr))
+                    else:
+                        sFile.write('# Output for {}\n'.format(entry))
+                        sFile.write('#=============================#\n')
+                        sFile.write('stdout:\n{}\n\n'.format(runOut))
+                        sFile.write('#=============================#\n')
+                        sFile.write('stderr:\n{}\n\n'.format(runErr))
+
+            if compileCode == 0 and not tests:
+                runOut.close()
+                runErr.close()
+
+        self.finishSubmission(workDir)
+        with open(os.path.join(workDir, 'outcomes.json'), 'w') as file:
+            json.dump(outcomes, file)
+        fileList.append('summary.txt')
+        return fileList
+
+    def writeIncremental(self, rubric):
+        """
+        Adds a graded student to the journal.
+
+        The journal is used as a backup in case the script crashes (or a break
+        needs to be taken.) It also keeps track of which students have been
+        marked.
+
+        Parameters:
+        ----------
+        rubric:
+            The rubric of the student that was just marked.
+        """
+        with traceSpan('journal', student = rubric.studentName):
+            self.journal.append(rubric)
+            if self.queue is not None and not self.queue.record(rubric):
+                print('Warning: {} was taken over by another marker, so this '
+                        'grade was not recorded.'.format(rubric.studentName))
+
+    def loadIncremental(self, file, masterRubric):
+        """
+        Loads the journal.
+
+        This restores the list of grades for students using the journal. An
+        incremental CSV file written by earlier versions in the same directory
+        is moved into the journal first.
+
+        Parameters:
+        ----------
+        file:
+            The name of the journal.
+        masterRubric:
+            The master rubric.
+
+        Returns:
+        -------
+            The restored table of students and their grades along with the set
+            of the names of the student directories that were restored.
+        """
+        self.journal = GradeJournal()
+        self.journal.path = file
+        csvPath = os.path.join(os.path.dirname(file), 'grades_inc.csv')
+        if os.path.isfile(csvPath) and not os.path.isfile(file):
+            self.journal.migrate(csvPath, masterRubric.schema)
+
+        table = self.journal.load(masterRubric.schema)
+        return table, {rubric.studentName for rubric in table}
+
+    def normalizeSource(self, text):
+        """
+        Strips the parts of the source code that do not change what it does,
+        so that copies with different comments or layout are found as
+        duplicates. By default the code is compared as it is.
+
+        Parameters:
+        ----------
+        text:
+            The source code.
+
+        Returns:
+        -------
+            The normalized code.
+        """
+        return text
+
+    def stagedAuxFiles(self):
+        """
+        Gets the auxiliary files that are copied into the sandbox of every
+        submission.
+
+        Returns:
+        -------
+            The list of auxiliary files.
+        """
+        return self.auxFiles
+
+    def stageSubmission(self, name, subPath, files = None):
+        """
+        Sets up a sandbox for the submission of a student.
+
+        Each submission gets its own sandbox inside the working directory so
+        that submissions can be run at the same time without interfering with
+        each other, and nothing a run leaves behind can leak into the next.
+
+        Parameters:
+        ----------
+        name:
+            The name of the student directory.
+        subPath:
+            The path to the submitted files of the student. If the root is an
+            archive, this is the directory of the files inside the archive.
+        files:
+            The hashes of the submitted files, as listed in the manifest. If
+            None, the files are found in subPath.
+
+        Returns:
+        -------
+            The sandbox and the submission bundle for runSubmission.
+        """
+        sandbox = Sandbox()
+        sandbox.root = self.workingDir
+        sandbox.create(prefix = name + '-')
+
+        try:
+            for file in self.inputFiles:
+                sandbox.link(file)
+
+            for file in self.outputFiles:
+                sandbox.link(file)
+
+            for file in self.stagedAuxFiles():
+                sandbox.link(file)
+
+            if self.preProcessScript:
+                sandbox.link(self.preProcessScript)
+
+            # Now copy the submission over to the sandbox.
+            if files is None:
+                if self.archive is not None:
+                    raise FileNotFoundError(subPath)
+                files = [file.name for file in os.scandir(subPath) if
+                        file.is_file()]
+
+            # Files inside an archive are streamed straight into the sandbox.
+            submission = []
+            for file in files:
+                if self.archive is not None:
+                    self.archive.extract(posixpath.join(subPath, file),
+                            os.path.join(sandbox.path, file))
+                else:
+                    sandbox.copy(os.path.join(subPath, file))
+                submission.append(file)
+        except:
+            sandbox.remove()
+            raise
+
+        return sandbox, [sandbox.path, submission]
+
+    def toolchainVersion(self):
+        """
+        Gets the version of the programs used to run the submissions.
+
+        Returns:
+        -------
+            The version string printed by the runtime.
+        """
+        proc = Process()
+        proc.procName = self.run
+        proc.procArgs = ['--version']
+        procOut, procErr, procCode = proc.runPiped()
+        return self.convertByteString(procOut + procErr)
+
+    def cacheSettings(self):
+        """
+        Gets the marker settings that change the results of a run.
+
+        Returns:
+        -------
+            The list of settings, which are part of the salt of the cache.
+        """
+        comparator = self.comparator
+        return [type(self).__name__, self.diff, self.maxFailures,
+                self.headSize, self.tailSize,
+                sorted(vars(self.limits).items()), comparator.maxHunks,
+                comparator.modes, comparator.tolerance,
+                sorted(comparator.outputModes.items())]
+
+    def setupCache(self):
+        """
+        Points the cache at the working directory and computes its salt from
+        the instructor files, the toolchain, and the marker settings.
+        """
+        # The cache lives in its own directory so that it survives the clean up
+        # of the working directory at the end of the session.
+        cacheDir = os.path.join(self.workingDir, 'cache')
+        os.makedirs(cacheDir, exist_ok = True)
+        self.cache.path = os.path.join(cacheDir, 'results.db')
+
+        files = list(self.inputFiles) + list(self.outputFiles) + \
+                list(self.auxFiles)
+        if self.preProcessScript:
+            files.append(self.preProcessScript)
+        for tests in self.tests.values():
+            for test in tests:
+                files += [test.input, test.output]
+
+        self.cache.setSalt(files, [self.toolchainVersion()] +
+                [repr(value) for value in self.cacheSettings()])
+
+    def processSubmission(self, name, subPath, files = None):
+        """
+        Stages, pre-processes, and runs the submission of a single student.
+
+        This only depends on its arguments and the marker settings, so it can
+        be sent to a worker process.
+
+        Parameters:
+        ----------
+        name:
+            The name of the student directory.
+        subPath:
+            The path to the submitted files of the student.
+        files:
+            The hashes of the submitted files, as listed in the manifest. If
+            None, the files are found in subPath.
+
+        Returns:
+        -------
+            The sandbox of the student and the list of files for the editor.
+        """
+        with traceSpan('stage', student = name):
+            sandbox, bundle = self.stageSubmission(name, subPath, files)
+        summaryPath = os.path.join(sandbox.path, 'summary.txt')
+        outcomesPath = os.path.join(sandbox.path, 'outcomes.json')
+
+        try:
+            # Unchanged submissions get the summary of their last run.
+            key = None
+            if self.cache is not None:
+                if files is None:
+                    files = {file: digestFile(os.path.join(sandbox.path,
+                        file)) for file in bundle[-1]}
+                key = self.cache.makeKey(files)
+                result = self.cache.get(key)
+                if result is not None:
+                    list, summary, outcomes = result
+                    with open(summaryPath, 'wb') as file:
+                        file.write(summary)
+                    with open(outcomesPath, 'wb') as file:
+                        file.write(outcomes)
+                    return sandbox, list
+
+            # Check if we have to run anything before.
+            if self.preProcessScript:
+                proc = Process()
+                proc.procName = 'python'
+                proc.procArgs = [self.preProcessScript]
+                proc.workingDir = sandbox.path
+                with traceSpan('preprocess', student = name):
+                    proc.run()
+
+            list = self.runSubmission(bundle)
+
+            if key is not None:
+                with open(summaryPath, 'rb') as file:
+                    summary = file.read()
+                with open(outcomesPath, 'rb') as file:
+                    outcomes = file.read()
+                self.cache.put(key, list, summary, outcomes)
+        except:
+            sandbox.remove()
+            raise
+
+        return sandbox, list
+
+    def executeSubmissions(self, students):
+        """
+        Runs the submissions of the given students.
+
+        In batch mode all of the submissions are run across a pool of processes
+        before the first one is returned. With a lookahead, the next few
+        submissions are run by a pool of threads while the current one is
+        being marked, so only that many student directories exist at any time.
+        Otherwise each submission is run only when it is requested.
+
+        Parameters:
+        ----------
+        students:
+            The list of student names, paths to their submitted files, and
+            hashes of the files as listed in the manifest. With a queue, this
+            is the generator returned by leaseStudents.
+
+        Returns:
+        -------
+            A generator yielding, in order, the name of the student, the path
+            to their submission, their directory, and the list of files for the
+            editor. If the submission could not be run, the sandbox is None and
+            the list is replaced by the traceback of the error.
+        """
+        if self.batch:
+            # Students leased from a queue are not known ahead of time, so
+            # only as many as there are workers are run at once.
+            pool = ProcessPoolExecutor(max_workers = self.workers)
+            if self.queue is not None:
+                depth = self.workers
+            else:
+                depth = len(students)
+        elif self.lookahead > 0:
+            pool = ThreadPoolExecutor(max_workers = self.lookahead)
+            depth = self.lookahead
+        else:
+            for name, subPath, files in students:
+                try:
+                    sandbox, list = self.processSubmission(name, subPath,
+                            files)
+                except Exception:
+                    sandbox, list = None, traceback.format_exc()
+                yield name, subPath, sandbox, list
+            return
+
+        with pool:
+            pending = deque()
+            upcoming = iter(students)
+            while True:
+                # Keep the current submission plus the next depth ones running.
+                while len(pending) <= depth:
+                    student = next(upcoming, None)
+                    if student is None:
+                        break
+                    future = pool.submit(self.processSubmission, *student)
+                    pending.append((student, future))
+
+                if not pending:
+                    break
+
+                (name, subPath, files), future = pending.popleft()
+                try:
+                    sandbox, list = future.result()
+                except Exception:
+                    sandbox, list = None, traceback.format_exc()
+                yield name, subPath, sandbox, list
+
+    def shareDuplicates(self, students, keys):
+        """
+        Runs the submissions of the given students, running only the first
+        submission of each group that has the same code.
+
+        The other submissions of a group are staged so the editor shows their
+        own files, and get the summary of the first one. The summary of every
+        submission in a group lists the rest of the group.
+
+        Parameters:
+        ----------
+        students:
+            The list of student names, paths to their submitted files, and
+            hashes of the files as listed in the manifest.
+        keys:
+            The hash of the code of each student, as returned by
+            hashSubmission.
+
+        Returns:
+        -------
+            A generator yielding the same values as executeSubmissions.
+        """
+        groups = {}
+        for name, subPath, hashes in students:
+            groups.setdefault(keys[name], []).append(name)
+
+        unique = [student for student in students if
+                groups[keys[student[0]]][0] == student[0]]
+        results = self.executeSubmissions(unique)
+        shared = {}
+        for name, subPath, hashes in students:
+            group = groups[keys[name]]
+            if group[0] == name:
+                name, subPath, sandbox, files = next(results)
+                if sandbox is not None and len(group) > 1:
+                    shared[keys[name]] = files[:], {result: self.readResult(
+                        sandbox, result) for result in RESULT_FILES}
+            elif keys[name] in shared:
+                files, contents = shared[keys[name]]
+                try:
+                    with traceSpan('stage', student = name):
+                        sandbox, bundle = self.stageSubmission(name, subPath,
+                                hashes)
+                    for result, data in contents.items():
+                        with open(os.path.join(sandbox.path, result),
+                                'wb') as file:
+                            file.write(data)
+                    files = files[:]
+                except Exception:
+                    sandbox, files = None, traceback.format_exc()
+            else:
+                # The first submission of the group could not be run, so this
+                # one is run on its own.
+                try:
+                    sandbox, files = self.processSubmission(name, subPath,
+                            hashes)
+                except Exception:
+                    sandbox, files = None, traceback.format_exc()
+
+            if sandbox is not None and len(group) > 1:
+                self.writeDuplicates(sandbox, name, group)
+            yield name, subPath, sandbox, files
+
+    def readResult(self, sandbox, result):
+        """
+        Reads one of the result files of a run.
+
+        Parameters:
+        ----------
+        sandbox:
+            The sandbox of the student.
+        result:
+            The name of the file, one of RESULT_FILES.
+
+        Returns:
+        -------
+            The contents of the file.
+        """
+        with open(os.path.join(sandbox.path, result), 'rb') as file:
+            return file.read()
+
+    def writeDuplicates(self, sandbox, name, group):
+        """
+        Lists the other submissions with the same code in the summary.
+
+        Parameters:
+        ----------
+        sandbox:
+            The sandbox of the student.
+        name:
+            The name of the student directory.
+        group:
+            The names of all the students with the same code.
+        """
+        summaryPath = os.path.join(sandbox.path, 'summary.txt')
+        with open(summaryPath, 'a', newline = '\n', encoding = 'utf-8') as sFile:
+            sFile.write('#=========================================#\n')
+            sFile.write('# Duplicate submissions\n')
+            sFile.write('#=========================================#\n')
+            sFile.write('Ignoring comments and whitespace, this submission '
+                    'has the same code as:\n')
+            for other in group:
+                if other != name:
+                    sFile.write('    {}\n'.format(other))
+            sFile.write('It was run once for all of them.\n\n')
+
+    def scanRoot(self, rootDir):
+        """
+        Updates the manifest of the root directory kept in the working
+        directory, so only the submissions that changed since the last session
+        are read again.
+
+        Parameters:
+        ----------
+        rootDir:
+            The root of the assignments.
+
+        Returns:
+        -------
+            The updated manifest.
+        """
+        # The manifest lives next to the cache, which survives the clean up
+        # of the working directory.
+        cacheDir = os.path.join(self.workingDir, 'cache')
+        os.makedirs(cacheDir, exist_ok = True)
+
+        manifest = Manifest()
+        manifest.path = os.path.join(cacheDir, 'manifest.json')
+        manifest.load()
+        manifest.scan(rootDir, self.archive)
+        manifest.save()
+        return manifest
+
+    def submissionPath(self, rootDir, name):
+        """
+        Gets the path to the submitted files of a student.
+
+        Parameters:
+        ----------
+        rootDir:
+            The root of the assignments.
+        name:
+            The name of the student directory.
+
+        Returns:
+        -------
+            The path, which is inside the archive if archive is set.
+        """
+        if self.archive is not None:
+            return posixpath.join(self.archive.prefix, name, SUBMISSION_DIR)
+        return os.path.join(rootDir, name, SUBMISSION_DIR)
+
+    def leaseStudents(self, rootDir, manifest):
+        """
+        Leases students from the queue, one at a time as they are needed.
+
+        Parameters:
+        ----------
+        rootDir:
+            The root of the assignments.
+        manifest:
+            The Manifest of the root.
+
+        Returns:
+        -------
+            A generator yielding the name of each student, the path to their
+            submitted files, and the hashes of the files.
+        """
+        while True:
+            name = self.queue.lease()
+            if name is None:
+                return
+            yield name, self.submissionPath(rootDir, name), \
+                    manifest.files(name)
+
+    def setup(self):
+        """
+        Prepares anything the language needs before the submissions are run.
+        """
+        pass
+
+    def teardown(self):
+        """
+        Releases anything set up by setup once marking is done.
+        """
+        pass
+
+    def reviewSubmission(self, sandbox, list, rubric):
+        """
+        Opens the files of a student in the editor along with the rubric, so
+        the grader can enter the marks and comments.
+
+        Parameters:
+        ----------
+        sandbox:
+            The sandbox of the student.
+        list:
+            The list of files for the editor.
+        rubric:
+            The rubric the grader starts from, with its marks and comments.
+
+        Returns:
+        -------
+            The rubric as the grader left it, without the name of the student.
+        """
+        rubricPath = os.path.join(sandbox.path, 'rubric.txt')
+        with open(rubricPath, 'w+') as rubricFile:
+            for item, mark, maxVal in rubric.items():
+                rubricFile.write('{}: {}/{}\n'.format(item, mark,
+                    maxVal))
+            rubricFile.write('#==============================#\n')
+            rubricFile.write('# Instructor comments\n')
+            rubricFile.write('#==============================#\n')
+            rubricFile.write(rubric.comments)
+
+        list.append('rubric.txt')
+        self.editor.run([os.path.join(sandbox.path, file) for file in
+            list])
+
+        # The grader has now entered the grades and comments, so lets
+        # re-open the file and update the marks.
+        studentRubric = Rubric(rubric.schema)
+        with open(rubricPath, 'r+') as rubricFile:
+            header = 0
+            comments = []
+            for line in rubricFile:
+                if line.startswith('#'):
+                    header += 1
+                    continue
+                if header is 3:
+                    comments.append(line)
+                    continue
+
+                tokens = line.split(':')
+                item = tokens[0]
+                vals = tokens[1].split('/')
+                if item not in studentRubric.schema.index:
+                    print('Warning: ignoring unknown rubric item {}.'.format(
+                        item))
+                    continue
+                studentRubric.setMark(item, float(vals[0]))
+
+        comments = ' '.join(comments)
+        studentRubric.comments = comments
+        return studentRubric
+
+    def mark(self, rootDir, rubric):
+        """
+        This is the main function of the Marker.
+
+        This will iterate over the directory of each student, read their
+        submission, compile and run it. It will then capture their output and
+        diff it. This will then be sent to the editor so the TA can mark the
+        assignment, unless an AutoGrader marks it from the outcomes of the
+        programs. It can also restore the list using an incremental file.
+        In batch mode, every submission is run ahead of time so the editor
+        never has to wait on a student's program.
+
+        Parameters:
+        ----------
+        rootDir:
+            The root of the assignemnts, which is a zip archive if archive is
+            set.
+        rubric:
+            The marking rubric to use.
+
+        Returns:
+        -------
+            The table containing all of the students, their marks and comments.
+        """
+        # Check if we have a partial journal already.
+        journalPath = os.path.join(self.workingDir, 'grades.journal')
+        table, marked = self.loadIncremental(journalPath, rubric)
+
+        # Gather the students that still have to be marked. Students are
+        # matched by the name of their directory, so the order of the
+        # directories does not matter and new ones can be added.
+        os.makedirs(self.workingDir, exist_ok = True)
+        with traceSpan('scan'):
+            manifest = self.scanRoot(rootDir)
+
+        students = []
+        keys = {}
+        if self.queue is not None:
+            # The class is shared with other markers, so students are leased
+            # only as they are about to be run. Grades of this marker that
+            # never reached the queue are recorded first, while the leases of
+            # the earlier session still hold them.
+            self.queue.add(manifest.students)
+            finished = self.queue.finished()
+            for studentRubric in table:
+                if studentRubric.studentName not in finished and \
+                        not self.queue.record(studentRubric):
+                    print('Warning: {} was marked by another marker, so the '
+                            'grade in the journal was not recorded.'.format(
+                                studentRubric.studentName))
+            self.queue.reclaim()
+            students = self.leaseStudents(rootDir, manifest)
+
+            # The workers lease students ahead of the grader, and the grader
+            # may spend a while on one, so the leases are kept alive until
+            # the marking is done.
+            self.queue.startHeartbeat()
+        else:
+            for name in manifest.students:
+                if name in marked:
+                    continue
+
+                subPath = self.submissionPath(rootDir, name)
+                files = manifest.files(name)
+                students.append((name, subPath, files))
+
+                # Submissions that cannot be read are kept apart by their name.
+                if self.duplicates:
+                    keys[name] = hashSubmission(subPath, files,
+                            self.extension, self.normalizeSource,
+                            self.archive) or name
+
+        # The salt of the cache covers the settings setup may change, so it is
+        # computed afterwards.
+        with traceSpan('setup'):
+            self.setup()
+
+        if self.cache is not None:
+            self.setupCache()
+
+        # Duplicates are found across the whole class, which a marker sharing
+        # a queue does not see.
+        if self.duplicates and self.queue is None:
+            submissions = self.shareDuplicates(students, keys)
+        else:
+            submissions = self.executeSubmissions(students)
+
+        # The estimate of the time left assumes the rest of the students take as
+        # long as the ones marked so far.
+        count = 0
+        done = 0
+        start = time.perf_counter()
+        for name, subPath, sandbox, list in submissions:
+            done += 1
+            if sandbox is None:
+                print('Error in entry {}'.format(count))
+                print('Path: {}'.format(subPath))
+                print(list)
+                continue
+
+            # The student may have been run long before the grader gets to
+            # them.
+            if self.queue is not None and not self.queue.renew(name):
+                print('Skipped {}: the lease ran out and another marker took '
+                        'them over.'.format(name))
+                sandbox.remove()
+                continue
+
+            # Students that are marked automatically only reach the editor
+            # when their marks need a second look.
+            if self.autoGrader is not None:
+                outcomesPath = os.path.join(sandbox.path, 'outcomes.json')
+                with open(outcomesPath) as file:
+                    outcomes = json.load(file)
+                studentRubric, review = self.autoGrader.grade(rubric.schema,
+                        outcomes)
+                if review:
+                    studentRubric = self.reviewSubmission(sandbox, list,
+                            studentRubric)
+            else:
+                studentRubric = self.reviewSubmission(sandbox, list, rubric)
+
+            studentRubric.studentName = name
+            table.append(studentRubric)
+            self.writeIncremental(studentRubric)
+
+            # Removing the sandbox takes care of the submission, the summary,
+            # the rubric, and any generated files.
+            sandbox.remove()
+
+            if self.queue is not None:
+                print('Marked {} ({} left in the queue)'.format(name,
+                    self.queue.remaining()))
+                continue
+
+            elapsed = time.perf_counter() - start
+            print('Marked {} ({} of {}, about {} left)'.format(name, done,
+                len(students), formatDuration(elapsed / done *
+                    (len(students) - done))))
+
+        if self.queue is not None:
+            self.queue.stopHeartbeat()
+
+        self.teardown()
+        if self.cache is not None:
+            self.cache.close()
+
+        # The grades of the other markers are merged in, so the table holds
+        # every student marked so far.
+        if self.queue is not None:
+            table = self.queue.grades(rubric.schema)
+        return table
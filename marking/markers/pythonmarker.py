@@ -0,0 +1,98 @@
+import io
+import os
+import tokenize
+import traceback
+from markers.marker import Marker
+from utils import traceSpan
+
+class PythonMarker(Marker):
+    """
+    The marker script for Python submissions.
+
+    Scripts are run as they are, but their syntax is checked first, which
+    stands in for the compile step of compiled languages.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.extension = '.py'
+        self.run = 'python'
+
+    def compileSources(self, sources, workDir):
+        """
+        Checks the syntax of the source files of a submission, without running
+        them or writing any bytecode.
+
+        The check is done in the interpreter running the marking script, not
+        the one the programs are run with, so that no process is started for
+        it. When the two are different versions, syntax that only one of them
+        accepts is judged by the marking script's: a program may fail to
+        "compile" yet run, or pass and then fail with a SyntaxError when run.
+
+        Parameters:
+        ----------
+        sources:
+            The names of the files to check.
+        workDir:
+            The directory containing the files.
+
+        Returns:
+        -------
+            A dictionary with the return code, the error, and an empty output
+            for each file. The return code is 1 if the file cannot be read or
+            has a syntax error.
+        """
+        results = {}
+        with traceSpan('compile', files = len(sources)):
+            for source in sources:
+                try:
+                    with tokenize.open(os.path.join(workDir, source)) as file:
+                        compile(file.read(), source, 'exec',
+                                dont_inherit = True)
+                except (SyntaxError, ValueError, UnicodeDecodeError) as e:
+                    results[source] = 1, ''.join(
+                            traceback.format_exception_only(type(e), e)), ''
+                    continue
+                results[source] = 0, '', ''
+        return results
+
+    def cacheSettings(self):
+        """
+        Gets the marker settings that change the results of a run, including
+        the syntax check, so results stored before it was added are not used.
+
+        Returns:
+        -------
+            The list of settings, which are part of the salt of the cache.
+        """
+        return super().cacheSettings() + ['syntax']
+
+    def normalizeSource(self, text):
+        """
+        Strips the comments and whitespace from Python source code.
+
+        Indentation is kept as the tokens that open and close each block, so
+        only the amount of indentation is ignored.
+
+        Parameters:
+        ----------
+        text:
+            The source code.
+
+        Returns:
+        -------
+            The tokens of the code, one per line. If the code cannot be
+            tokenized, it is returned unchanged.
+        """
+        tokens = []
+        try:
+            for token in tokenize.generate_tokens(io.StringIO(text).readline):
+                if token.type in (tokenize.COMMENT, tokenize.NL):
+                    continue
+                if token.type == tokenize.INDENT:
+                    tokens.append('{}:'.format(token.type))
+                else:
+                    tokens.append('{}:{}'.format(token.type, token.string))
+        except (tokenize.TokenError, SyntaxError):
+            return text
+        return '\n'.join(tokens)
@@ -1,13 +1,19 @@
 import argparse
+import getpass
 import os
+import socket
 import time
 import csv
-import traceback
+import io
+import zipfile
 import configparser
-from os.path import basename
-from utils import Config, Editor, Rubric 
-from javamarker import JavaMarker
-from pythonmarker import PythonMarker
+import utils
+from concurrent.futures import ThreadPoolExecutor
+from utils import Config, Editor, Rubric, RubricSchema, Limits
+from utils import NORMALIZE_MODES, useAsyncRunner, useTracer
+from utils import findTestCases, ResultCache, GradeTable, Archive
+from utils import AutoRule, AutoGrader, REVIEW_MODES, WorkQueue
+from markers import findMarker
 
 def convertPaths(path, join = False):
     """
@@ -35,68 +41,74 @@ def convertPaths(path, join = False):
 
     return dir
 
-def makeComments(grades, root):
+def makeComments(grades, root, archive = None):
     """
     Creates the comments.txt file for each student submission.
 
     This utilizes the comments section from the rubrics to create the
-    corresponding file for each student in the list.
+    corresponding file for each student in the list. Students without a
+    rubric (because they submitted nothing or they submitted garbage) are
+    skipped, so the root does not need to be listed again.
 
     Parameters:
     ----------
     grades:
-        The list of all the rubrics of all the students.
+        The GradeTable of all the rubrics of all the students.
     root:
         The root containing the student directories.
+    archive:
+        The Archive of the root, if the root is a zip archive. The comments
+        are then written to its output archive.
     """
-    for entry in os.scandir(root):
-        if not entry.is_dir():
+    for name, studentRubric in grades.byName.items():
+        # Now we have to generate the comments.txt file.
+        file = io.StringIO()
+        file.write('<pre>#=============================#\n')
+        file.write('# Instructor\'s comments\n')
+        file.write('#=============================#\n')
+        for item, mark, maxVal in studentRubric.items():
+            file.write('{}: {}/{}\n'.format(item, mark, maxVal))
+
+        file.write('Total: {}\n'.format(studentRubric.total))
+        file.write('Comments:\n{}'.format(studentRubric.comments))
+
+        if archive is not None:
+            archive.write('{}/comments.txt'.format(name), file.getvalue())
             continue
 
-        # We need to find the appropriate rubric.
-        name = entry.name
+        commentsPath = os.path.join(root, name, 'comments.txt')
         try:
-            studentRubric = next(x for x in grades if x.studentName == name)
-        except Exception as e:
-            # If we can't find the student name in our list of marks, then
-            # either they submitted nothing or they submitted garbage, so 
-            # skip them.
+            with open(commentsPath, 'w+', newline = '\n') as outFile:
+                outFile.write(file.getvalue())
+        except FileNotFoundError:
+            # The student directory was removed after it was marked.
             continue
 
-        # Now switch into the students directory.
-        os.chdir(entry.path)
-
-        # Now we have to generate the comments.txt file.
-        with open('comments.txt', 'w+', newline = '\n') as file:
-            file.write('<pre>#=============================#\n')
-            file.write('# Instructor\'s comments\n')
-            file.write('#=============================#\n')
-            i = 0
-            for item, mark in studentRubric.attributes.items():
-                file.write('{}: {}/{}\n'.format(item, mark,
-                                                studentRubric.maxVals[i]))
-                i += 1
-
-            file.write('Total: {}\n'.format(studentRubric.total))
-            file.write('Comments:\n{}'.format(studentRubric.comments))
-
-def makeCSV(grades, root):
+def makeCSV(grades, root, archive = None):
     """
     Populates the connex generated CSV file with the grades of all students.
 
     Parameters:
     ----------
     grades:
-        The list of rubrics for each student.
+        The GradeTable of the rubrics for each student.
     root:
         The directory containing the student submissions and the CSV file.
+    archive:
+        The Archive of the root, if the root is a zip archive. The CSV file is
+        then read from it and written to its output archive.
     """
     filePath = os.path.join(root, 'grades.csv')
     rows = []
-    with open(filePath, 'r+') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            rows.append(row)
+    if archive is not None:
+        member = '/'.join(filter(None, [archive.prefix, 'grades.csv']))
+        text = archive.read(member).decode('utf-8')
+        rows = list(csv.reader(io.StringIO(text, newline = '')))
+    else:
+        with open(filePath, 'r+') as file:
+            reader = csv.reader(file)
+            for row in reader:
+                rows.append(row)
 
     # Now fill in the total mark.
     for i in range(3, len(rows)):
@@ -104,19 +116,69 @@ def makeCSV(grades, root):
         lastName = rows[i][2]
         firstName = rows[i][3]
 
-        name = lastName + ', ' + firstName + '(' + id + ')'
-        try:
-            studentRubric = next(x for x in grades if x.studentName == name)
-        except Exception as e:
+        name = '{}, {}({})'.format(lastName, firstName, id)
+        studentRubric = grades.find(name = name, id = id)
+        if studentRubric is None:
             continue
 
         rows[i][-1] = studentRubric.total
 
     # Now let's write out the csv file.
+    if archive is not None:
+        file = io.StringIO(newline = '\n')
+        csv.writer(file).writerows(rows)
+        archive.write('grades.csv', file.getvalue())
+        return
+
     with open(filePath, 'w+', newline = '\n') as file:
         writer = csv.writer(file)
         writer.writerows(rows)
 
+def printStatistics(grades, rubric):
+    """
+    Prints the class average of each element of the rubric and statistics of
+    the totals.
+
+    Parameters:
+    ----------
+    grades:
+        The GradeTable of the rubrics for each student.
+    rubric:
+        The marking rubric.
+    """
+    stats = grades.statistics()
+    if stats is None:
+        return
+
+    averages, average, median, lowest, highest = stats
+    schema = rubric.schema
+    print('Class statistics:')
+    for item, mark, maxVal in zip(schema.items, averages, schema.maxVals):
+        print('    {}: {:.2f}/{}'.format(item, mark, maxVal))
+    print('    Total: average {:.2f}, median {:.2f}, lowest {}, highest {} '
+            '(out of {})'.format(average, median, lowest, highest,
+                schema.total))
+
+def printTrace(since):
+    """
+    Prints how long each stage of the session took.
+
+    Parameters:
+    ----------
+    since:
+        The time the session started at.
+    """
+    summary = utils.tracer.summary(since)
+    utils.tracer.close()
+    if not summary:
+        return
+
+    print('Time spent in each stage:')
+    for stage, stats in summary.items():
+        print('    {}: {} spans, {:.2f}s in total, p50 {:.3f}s, '
+                'p95 {:.3f}s'.format(stage, stats['count'], stats['total'],
+                    stats['p50'], stats['p95']))
+
 def readConfigFile(path):
     """
     Reads the provided ini file and obtains all the details.
@@ -136,6 +198,17 @@ def readConfigFile(path):
     conf.makeComments = config['Config'].getboolean('makeComments')
     conf.workingDir = convertPaths(config['Config']['working'])
 
+    # Batch mode is optional, as is the number of processes it uses.
+    if config.has_option('Config', 'batch'):
+        conf.batch = config['Config'].getboolean('batch')
+    if config.has_option('Config', 'workers'):
+        conf.workers = config['Config'].getint('workers')
+    if config.has_option('Config', 'lookahead'):
+        conf.lookahead = config['Config'].getint('lookahead')
+    if config.has_option('Config', 'duplicates'):
+        conf.duplicates = config['Config'].getboolean('duplicates')
+    if config.has_option('Config', 'trace'):
+        conf.trace = convertPaths(config['Config']['trace'])
 
     # Now let's read in the editor
     editor = Editor()
@@ -146,20 +219,21 @@ def readConfigFile(path):
     if config.has_option('Editor', 'editorArgs'):
         editor.args = config['Editor']['editorArgs']
 
-    # Now make the Marker depending on the language that we are using.
-    # TODO: if more languages are needed, this needs to be replaced with a 
-    # dynamic loading of modules.
+    # Now make the Marker depending on the language that we are using. Only
+    # the module of that marker is imported.
     conf.language = config['Language']['name']
-    if conf.language == 'java':
-        marker = JavaMarker()
-    elif conf.language == 'python':
-        marker = PythonMarker()
-    else:
+    markerClass = findMarker(conf.language)
+    if markerClass is None:
         print("Error: language is not supported yet.")
         return
+    marker = markerClass()
 
     marker.editor = editor
     marker.workingDir = conf.workingDir
+    marker.batch = conf.batch
+    marker.workers = conf.workers
+    marker.lookahead = conf.lookahead
+    marker.duplicates = conf.duplicates
 
     # The IO section is optional, so only parse it if needed.
     if config.has_section('IO'):
@@ -183,6 +257,75 @@ def readConfigFile(path):
         if config.has_option('IO', 'diff'):
             marker.diff = config['IO'].getboolean('diff')
 
+        if config.has_option('IO', 'maxHunks'):
+            marker.comparator.maxHunks = config['IO'].getint('maxHunks')
+
+        # The normalization can be given for all outputs with normalize, and
+        # for a single output with normalize.<name>.
+        for key in config['IO']:
+            if key != 'normalize' and not key.startswith('normalize.'):
+                continue
+            modes = [mode.strip().lower() for mode in
+                    config['IO'][key].split(',') if mode.strip()]
+            for mode in modes:
+                if mode not in NORMALIZE_MODES:
+                    print('Error: unknown normalization mode {}.'.format(mode))
+                    return
+            if key == 'normalize':
+                marker.comparator.modes = modes
+            else:
+                name = key[len('normalize.'):]
+                marker.comparator.outputModes[name] = modes
+
+        if config.has_option('IO', 'tolerance'):
+            marker.comparator.tolerance = config['IO'].getfloat('tolerance')
+
+        if config.has_option('IO', 'tests'):
+            marker.tests = findTestCases(convertPaths(config['IO']['tests']))
+
+        if config.has_option('IO', 'maxFailures'):
+            marker.maxFailures = config['IO'].getint('maxFailures')
+
+    # The Run section is optional too. Sizes are given in MB for memory and KB
+    # for output to keep the ini file readable.
+    if config.has_section('Run'):
+        limits = Limits()
+        if config.has_option('Run', 'timeout'):
+            limits.timeout = config['Run'].getfloat('timeout')
+        if config.has_option('Run', 'cpu'):
+            limits.cpu = config['Run'].getint('cpu')
+        if config.has_option('Run', 'memory'):
+            limits.memory = config['Run'].getint('memory') * 1024 * 1024
+        if config.has_option('Run', 'output'):
+            limits.output = config['Run'].getint('output') * 1024
+        marker.limits = limits
+
+        # Setting a head or tail size streams the output of the programs to
+        # disk and keeps only its start and end in memory.
+        if config.has_option('Run', 'head'):
+            marker.headSize = config['Run'].getint('head') * 1024
+        if config.has_option('Run', 'tail'):
+            marker.tailSize = config['Run'].getint('tail') * 1024
+
+        # With the async backend, every process is run on one event loop, and
+        # processes caps how many student programs run at once in each
+        # process of the marker.
+        if config.has_option('Run', 'backend'):
+            backend = config['Run']['backend'].lower()
+            if backend == 'async':
+                processes = 0
+                if config.has_option('Run', 'processes'):
+                    processes = config['Run'].getint('processes')
+                useAsyncRunner(processes)
+            elif backend != 'threads':
+                print('Error: unknown backend {}.'.format(backend))
+                return
+
+    # The settings of the language itself, such as the Java section, are read
+    # by its marker.
+    if not marker.configure(config):
+        return
+
     # The Aux section is also optional.
     if config.has_section('Aux'):
         if config.has_option('Aux', 'files'):
@@ -196,11 +339,66 @@ def readConfigFile(path):
             script = config['Aux']['script']
             marker.preProcessScript = convertPaths(script)
 
+    # The Cache section is optional. The size is given in MB.
+    if config.has_section('Cache'):
+        marker.cache = ResultCache()
+        if config.has_option('Cache', 'size'):
+            marker.cache.maxSize = config['Cache'].getint('size') * 1024 * 1024
+
+    # The Queue section is optional. If present, the class is shared with
+    # every marker that uses the same queue. The lease is given in minutes.
+    if config.has_section('Queue'):
+        marker.queue = WorkQueue()
+        marker.queue.path = convertPaths(config['Queue']['path'])
+        marker.queue.owner = '{}@{}'.format(getpass.getuser(),
+                socket.gethostname())
+        if config.has_option('Queue', 'owner'):
+            marker.queue.owner = config['Queue']['owner']
+        if config.has_option('Queue', 'lease'):
+            marker.queue.leaseTime = config['Queue'].getfloat('lease') * 60
+
     # Finally, we read the rubric.
-    rubric = Rubric()
+    items = []
+    maxVals = []
     for key in config['Rubric']:
-        rubric.attributes[key] = 0
-        rubric.maxVals.append(config['Rubric'].getfloat(key))
+        items.append(key)
+        maxVals.append(config['Rubric'].getfloat(key))
+    rubric = Rubric(RubricSchema(items, maxVals))
+
+    # The Auto section is optional. Each of its items binds an element of the
+    # rubric to the outcome of a program, so the class can be marked without
+    # the editor.
+    if config.has_section('Auto'):
+        autoGrader = AutoGrader()
+        for key in config['Auto']:
+            if key == 'review':
+                review = config['Auto']['review'].lower()
+                if review not in REVIEW_MODES:
+                    print('Error: unknown review mode {}.'.format(review))
+                    return
+                autoGrader.review = review
+                continue
+
+            if key not in rubric.schema.index:
+                print('Error: {} is not in the rubric.'.format(key))
+                return
+            rule = AutoRule()
+            try:
+                rule.parse(key, config['Auto'][key])
+            except ValueError as error:
+                print('Error: {}.'.format(error))
+                return
+            maxVal = rubric.schema.maxVals[rubric.schema.index[key]]
+            if rule.marks is not None and rule.marks > maxVal:
+                print('Error: {} is worth at most {}.'.format(key, maxVal))
+                return
+            autoGrader.rules.append(rule)
+        marker.autoGrader = autoGrader
+
+        # Nobody waits on the editor between students, so the whole class is
+        # run at once unless asked otherwise.
+        if not config.has_option('Config', 'batch') and not conf.lookahead:
+            marker.batch = True
 
     return conf, marker, rubric
 
@@ -217,12 +415,32 @@ def makeSampleConfig():
 # Lines that start with \'#\' are comments.
 
 [Config]
-# Specifies the root directory of the assignments.
+# Specifies the root directory of the assignments. This may also be the zip
+# archive exported by the LMS, which is read without extracting it. The
+# comments and grades are then written to a new archive next to it, named
+# after it with -marked added.
 root = path/to/root
 # If true, the script will populate the CSV file with the marks.
 makeCSV = true
 # If true, the script will generate the comments files for all students.
 makeComments = true
+# If true, all submissions are compiled and run before marking starts, so
+# the editor opens without waiting for each student. Optional.
+# batch = true
+# The number of processes used in batch mode. Defaults to the number of
+# CPUs.
+# workers = 4
+# If batch mode is off, the number of upcoming submissions that are run in
+# the background while the current one is marked. Optional, 0 by default.
+# lookahead = 2
+# If true, submissions whose code is the same once comments and whitespace
+# are removed are only run once, and share their results. The summary of
+# each one lists the others. Optional.
+# duplicates = true
+# If set, the time spent in each stage of marking (staging, compiling,
+# running, diffing, the editor, and so on) is appended to this file as lines
+# of JSON, and a summary is printed once marking is done. Optional.
+# trace = trace.jsonl
 
 [Editor]
 # Specify the executable path of the editor of choice.
@@ -250,6 +468,66 @@ output = /path/to/file1;/path/to/file2
 # Tells the script whether a diff should be performed between the
 # student's output and the provided master.
 diff = true
+# The maximum number of blocks of differences written to the summary. If
+# not given, the full diff is written.
+maxHunks = 10
+# The normalizations applied to the outputs before they are compared,
+# separated by commas. Any of:
+#   trailing: ignore trailing whitespace on each line.
+#   blank: treat runs of blank lines as one and ignore them at the end.
+#   case: ignore the case of letters.
+#   float: treat numbers within the tolerance of each other as equal.
+#   token: compare lines as sequences of whitespace separated tokens.
+normalize = trailing, blank
+# The normalizations for a single output, in place of the ones above.
+normalize.file1 = token, float
+# The tolerance used by the float normalization.
+tolerance = 0.001
+# The directory holding the test cases of the programs. Each test case is a
+# pair of files called name.N.in and name.N.out, where name is the name of
+# the program and N is the number of the test case. Programs with test
+# cases are run once per test case instead of with the files above.
+tests = /path/to/tests
+# The number of failed test cases after which the rest of the test cases of
+# a program are skipped. If not given, all of them are run.
+maxFailures = 3
+
+# The Run section is optional. It limits the resources that the student
+# programs may use, and any program that goes over a limit is stopped. The
+# reason is written to the summary. Leave out a limit to disable it.
+[Run]
+# The wall-clock time (in seconds) a program may run for.
+timeout = 10
+# The CPU time (in seconds) a program may use.
+cpu = 10
+# The memory (in MB) a program may use.
+memory = 512
+# The combined size (in KB) of stdout and stderr a program may write.
+output = 1024
+# If set, the output of each program is streamed to a temporary file and
+# only its first head and last tail KB are kept in memory and written to
+# the summary. The diff still reads the full output.
+head = 64
+tail = 64
+# How programs are run. With threads, each program gets threads that read
+# its output. With async, all programs are run on a single event loop.
+backend = async
+# With the async backend, the number of student programs that may run at
+# the same time. The editor and compilers do not count towards it. In batch
+# mode it applies to each worker process. Defaults to the number of CPUs.
+processes = 8
+
+# The Java section is optional, and only used for Java assignments.
+[Java]
+# If true, programs are run inside warm JVMs that are reused for all the
+# programs and test cases of a submission, instead of starting a new JVM
+# for every run. Programs that call System.exit are run again in a new JVM.
+harness = true
+# How submissions are compiled. With file, javac is run once per file.
+# With batch, javac is run once per submission with all of its files, and
+# the errors are split by file in the summary. With server, submissions are
+# compiled in batches by a warm JVM that is reused for the whole session.
+compile = batch
 
 # The Aux section is also optional. Add this if the assignment requires:
 # additional instructor provided files (either code or files the
@@ -262,11 +540,53 @@ files = /path/to/file1;/path/to/file2
 # If a pre-processing script is required, specify it here.
 script = /path/to/script
 
+# The Cache section is optional. If present, the results of running each
+# submission are stored in the working directory, and submissions that
+# have not changed since an earlier session are not run again. Changing
+# any instructor file, the script, the toolchain, or the settings above
+# causes every submission to be run again.
+[Cache]
+# The total size in MB of the stored results, after which the least
+# recently used ones are removed. 0 means no limit.
+size = 256
+
+# The Queue section is optional. If present, the class is shared by every
+# marker that points at the same queue, such as several graders working
+# on a shared filesystem, each with their own working directory. Every
+# marker takes the next student nobody is marking, and the comments and
+# CSV file are written by whichever marker finds every student marked.
+# Running the script again once the others are done writes them too.
+# [Queue]
+# The SQLite database that holds the students and their grades.
+# path = /path/to/queue.db
+# The minutes after which the students of a marker that stopped are
+# given to another marker. Defaults to 30.
+# lease = 30
+# The name of this marker. Defaults to the user and host name, and must
+# be different for every marker.
+# owner = grader1
+
 [Rubric]
 # This is the marking rubric. Each item goes in a separate line, and it
 # must be assigned to the maximum number of marks per item.
 item 1 = 1
 item 2 = 2
+
+# The Auto section is optional. If present, students are marked from the
+# outcomes of their programs instead of in the editor. Each item of the
+# rubric is bound to a rule made of a kind, the name of the program (or
+# of the test case), and optionally the marks it is worth, which default to
+# the whole item. The kinds are compile, run (ran without errors), diff
+# (the output matched), test (a single test case passed) and tests (the
+# marks are split over the test cases that passed). Items without a rule
+# are left at 0. The reason for each mark is added to the comments.
+# [Auto]
+# Which students are opened in the editor afterwards: none, ambiguous
+# (a program went over a limit, was not found, or had nothing to compare
+# against) or all.
+# review = ambiguous
+# item 1 = compile Test
+# item 2 = tests Test
         """
         file.write(sample)
 
@@ -300,15 +620,56 @@ def main():
 
     # Now that we have the path, let's start setting things up.
     conf, marker, rubric = readConfigFile(configPath)
-
-    grades = marker.mark(conf.root, rubric)
-
-    # Check if we have to generate the csv files and comment files
-    if conf.makeComments:
-        makeComments(grades, conf.root)
-
-    if conf.makeCSV:
-        makeCSV(grades, conf.root)
+    sessionStart = time.time()
+    if conf.trace:
+        useTracer(conf.trace)
+
+    # The root may be the zip archive exported by the LMS, in which case the
+    # comments and grades go to a new archive next to it.
+    archive = None
+    if os.path.isfile(conf.root) and zipfile.is_zipfile(conf.root):
+        archive = Archive()
+        archive.path = conf.root
+        archive.outputPath = os.path.splitext(conf.root)[0] + '-marked.zip'
+        marker.archive = archive
+
+    grades = GradeTable()
+    grades.index(marker.mark(conf.root, rubric))
+
+    # With a queue, the grades are written out only once the other markers
+    # are done.
+    if marker.queue is not None:
+        remaining = marker.queue.remaining()
+        marker.queue.close()
+        if remaining:
+            print('{} students are still being marked by others. Run the '
+                    'script again once they are done to write the '
+                    'grades.'.format(remaining))
+            if archive is not None:
+                archive.close()
+            return
+
+    # Check if we have to generate the csv files and comment files. They
+    # don't touch the same files, so they are written at the same time.
+    with ThreadPoolExecutor(max_workers = 2) as pool:
+        exports = []
+        if conf.makeComments:
+            exports.append(pool.submit(makeComments, grades, conf.root,
+                archive))
+
+        if conf.makeCSV:
+            exports.append(pool.submit(makeCSV, grades, conf.root,
+                archive))
+
+        for export in exports:
+            export.result()
+
+    if archive is not None:
+        archive.close()
+
+    printStatistics(grades, rubric)
+    if conf.trace:
+        printTrace(sessionStart)
 
     # Only remove the incremental file if we have written everything to
     # the CSV and comment files.
@@ -2,56 +2,2207 @@
 Utility module containing classes used by the main marking module.
 """
 
+import asyncio
+import codecs
+import contextlib
+import csv
+import difflib
+import hashlib
+import io
+import json
+import math
 import os
-from subprocess import Popen, PIPE
-from copy import deepcopy
+import posixpath
+import re
+import signal
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, TimeoutExpired
+from array import array
+from itertools import zip_longest
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The ioctl request used by Linux to clone (reflink) a file.
+FICLONE = 0x40049409
+
+# The ways in which a process started by Process.runPiped can end.
+STATUS_FINISHED = 'finished'
+STATUS_TIMEOUT = 'timeout'
+STATUS_CPU = 'cpu'
+STATUS_MEMORY = 'memory'
+STATUS_OUTPUT = 'output'
+
+# The outcomes of a submission a rubric item can be bound to when marking
+# automatically.
+AUTO_COMPILE = 'compile'
+AUTO_RUN = 'run'
+AUTO_DIFF = 'diff'
+AUTO_TEST = 'test'
+AUTO_TESTS = 'tests'
+AUTO_KINDS = [AUTO_COMPILE, AUTO_RUN, AUTO_DIFF, AUTO_TEST, AUTO_TESTS]
+
+# Which students are opened in the editor when marking automatically.
+REVIEW_NONE = 'none'
+REVIEW_AMBIGUOUS = 'ambiguous'
+REVIEW_ALL = 'all'
+REVIEW_MODES = [REVIEW_NONE, REVIEW_AMBIGUOUS, REVIEW_ALL]
+
+# The directory holding the submitted files inside each student directory.
+SUBMISSION_DIR = 'Submission attachment(s)'
+
+# The size of the chunks in which the pipes of a process are read.
+CHUNK_SIZE = 64 * 1024
+
+# The normalizations that can be applied to outputs before comparing them.
+NORMALIZE_TRAILING = 'trailing'
+NORMALIZE_BLANK = 'blank'
+NORMALIZE_CASE = 'case'
+NORMALIZE_FLOAT = 'float'
+NORMALIZE_TOKEN = 'token'
+NORMALIZE_MODES = [NORMALIZE_TRAILING, NORMALIZE_BLANK, NORMALIZE_CASE,
+        NORMALIZE_FLOAT, NORMALIZE_TOKEN]
+
+class Limits:
+    """
+    The resource limits applied to the programs of the students.
+
+    A limit of 0 means that the resource is not limited.
+
+    Attributes
+    ----------
+    timeout:
+        The wall-clock time (in seconds) a program may run for.
+    cpu:
+        The CPU time (in seconds) a program may use.
+    memory:
+        The address space (in bytes) a program may use.
+    output:
+        The combined size (in bytes) of stdout and stderr a program may write.
+    """
+    def __init__(self):
+        self.timeout = 0
+        self.cpu = 0
+        self.memory = 0
+        self.output = 0
+
+    def describe(self, status):
+        """
+        Describes why a program was stopped.
+
+        Parameters
+        ----------
+        status:
+            The status of the program as set by Process.runPiped.
+
+        Returns
+        -------
+            A sentence describing the status.
+        """
+        if status == STATUS_TIMEOUT:
+            return 'Program stopped: time limit of {} seconds exceeded.'.format(
+                    self.timeout)
+        if status == STATUS_CPU:
+            return 'Program stopped: CPU limit of {} seconds exceeded.'.format(
+                    self.cpu)
+        if status == STATUS_MEMORY:
+            return 'Program stopped: ran out of memory.'
+        if status == STATUS_OUTPUT:
+            return 'Program stopped: output limit of {} bytes exceeded.'.format(
+                    self.output)
+        return 'Program finished.'
+
+class AsyncRunner:
+    """
+    Runs the processes started by Process on a single asyncio event loop.
+
+    The loop runs in a background thread that is shared by every Process, so
+    the pipes of all the processes are read by the loop instead of by a set of
+    threads per process. At most maxProcesses student programs run at the same
+    time; the rest wait for their turn on a semaphore. Other processes, such as
+    the editor and the compiler, do not wait for a turn.
+
+    Note
+    ----
+    In batch mode each worker process has its own runner, so maxProcesses
+    applies to each worker rather than to the whole session.
+
+    Attributes
+    ----------
+    maxProcesses:
+        The number of processes that can run at the same time.
+    loop:
+        The event loop. None until the runner is first used.
+    thread:
+        The thread running the loop.
+    semaphore:
+        Limits the number of processes running at the same time. Created by
+        the loop on first use.
+    pid:
+        The id of the process that started the loop. A worker process forked
+        from it starts its own.
+    lock:
+        Guards the start of the loop.
+    """
+    def __init__(self):
+        self.maxProcesses = os.cpu_count() or 1
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.pid = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the event loop in its thread if it is not running in this
+        process yet.
+        """
+        with self.lock:
+            if self.loop is not None and self.pid == os.getpid():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.semaphore = None
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target = self.loop.run_forever,
+                    daemon = True)
+            self.thread.start()
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the event loop and waits for its result.
+
+        Parameters
+        ----------
+        coroutine:
+            The coroutine to run.
+
+        Returns
+        -------
+            The result of the coroutine.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def getSemaphore(self):
+        """
+        Gets the semaphore limiting the number of processes. Must be called
+        from the event loop.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.maxProcesses)
+        return self.semaphore
+
+    @contextlib.asynccontextmanager
+    async def slot(self, student):
+        """
+        Waits for the turn of a process, if it runs a student program. Must be
+        used from the event loop.
+
+        Parameters
+        ----------
+        student:
+            Whether the process runs a student program.
+        """
+        if not student:
+            yield
+            return
+        async with self.getSemaphore():
+            yield
+
+# The runner used by every Process. If None, processes are run with Popen and
+# their pipes are read by threads.
+asyncRunner = None
+
+def useAsyncRunner(maxProcesses = 0):
+    """
+    Makes every Process run on a shared asyncio event loop.
+
+    Parameters
+    ----------
+    maxProcesses:
+        The number of processes that can run at the same time. If 0, this is
+        the number of CPUs.
+    """
+    global asyncRunner
+    asyncRunner = AsyncRunner()
+    if maxProcesses:
+        asyncRunner.maxProcesses = maxProcesses
+
+def percentile(values, fraction):
+    """
+    Finds the value below which the given fraction of the values fall, using
+    the nearest rank.
+
+    Parameters
+    ----------
+    values:
+        The sorted list of values.
+    fraction:
+        The fraction of the values, between 0 and 1.
+
+    Returns
+    -------
+        The value at that rank.
+    """
+    rank = max(math.ceil(fraction * len(values)), 1)
+    return values[rank - 1]
+
+class Tracer:
+    """
+    Records how long each stage of a marking session takes.
+
+    Each span is written as soon as it ends, as a line of JSON holding the
+    stage, the time it started at, its duration, the process and thread it ran
+    in, and any details given for it. Worker processes append their spans to
+    the same file, so the summary covers the whole session.
+
+    Attributes
+    ----------
+    path:
+        The file the spans are written to.
+    fd:
+        The file descriptor of the file, opened by the process in pid.
+    pid:
+        The process that opened fd.
+    lock:
+        Guards fd, since spans end in several threads.
+    """
+    def __init__(self):
+        self.path = ''
+        self.fd = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Leaves the file out when the tracer is sent to another process, which
+        opens its own.
+        """
+        state = self.__dict__.copy()
+        state['fd'] = None
+        state['pid'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        """
+        Appends a record to the file.
+
+        Each record is written with a single call on a file opened for
+        appending, so records from several processes do not interleave.
+
+        Parameters
+        ----------
+        record:
+            The dictionary to write.
+        """
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self.lock:
+            if self.fd is None or self.pid != os.getpid():
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND |
+                        os.O_CREAT, 0o644)
+                self.pid = os.getpid()
+            os.write(self.fd, line)
+
+    def record(self, stage, start, duration, details):
+        """
+        Writes a span.
+
+        Parameters
+        ----------
+        stage:
+            The name of the stage.
+        start:
+            The time the span started at, in seconds since the epoch.
+        duration:
+            The length of the span, in seconds.
+        details:
+            A dictionary with anything else worth knowing about the span.
+        """
+        record = {'type': 'span', 'stage': stage, 'start': start,
+                'duration': duration, 'pid': os.getpid(),
+                'thread': threading.get_ident()}
+        record.update(details)
+        self.write(record)
+
+    def summary(self, since = 0):
+        """
+        Summarizes the spans in the file.
+
+        Parameters
+        ----------
+        since:
+            The time the session started at. Spans from earlier sessions are
+            left out.
+
+        Returns
+        -------
+            A dictionary with the number of spans, the total time, and the
+            50th and 95th percentile of the durations of each stage.
+        """
+        durations = {}
+        try:
+            with open(self.path, encoding = 'utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('type') != 'span' or \
+                            record['start'] < since:
+                        continue
+                    durations.setdefault(record['stage'], []).append(
+                            record['duration'])
+        except FileNotFoundError:
+            return {}
+
+        summary = {}
+        for stage, values in sorted(durations.items()):
+            values.sort()
+            summary[stage] = {
+                'count': len(values),
+                'total': sum(values),
+                'p50': percentile(values, 0.5),
+                'p95': percentile(values, 0.95),
+            }
+        return summary
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        with self.lock:
+            if self.fd is not None and self.pid == os.getpid():
+                os.close(self.fd)
+            self.fd = None
+
+# The tracer that receives the spans of every stage. If None, nothing is
+# recorded.
+tracer = None
+
+def useTracer(path):
+    """
+    Records the spans of every stage to the given file.
+
+    Parameters
+    ----------
+    path:
+        The file the spans are appended to.
+    """
+    global tracer
+    tracer = Tracer()
+    tracer.path = path
+
+@contextlib.contextmanager
+def traceSpan(stage, **details):
+    """
+    Records the time spent in the body of the with statement as a span of the
+    given stage. Does nothing if no tracer is in use.
+
+    Parameters
+    ----------
+    stage:
+        The name of the stage.
+    details:
+        Anything else worth knowing about the span, such as the student.
+    """
+    if tracer is None:
+        yield
+        return
+
+    start = time.time()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        tracer.record(stage, start, time.perf_counter() - begin, details)
 
 class Process:
     """
-    Serves as a wrapper for the logic of Popen.
+    Serves as a wrapper for the logic of Popen.
+
+    Attributes
+    ----------
+    procName:
+        The name of the process (executable) to run.
+    procArgs: 
+        The list of arguments that the process specified in procArgs takes.
+    workingDir:
+        The directory the process is run from. If empty, the process inherits
+        the current directory.
+    limits:
+        The Limits applied by runPiped. If None, the process is not limited.
+    status:
+        How the last call to runPiped ended (one of the STATUS_ values).
+    student:
+        Whether the process runs a student program. Only student programs
+        wait for a turn on the async runner.
+    """
+    def __init__(self):
+        self.procName = ''
+        self.procArgs = []
+        self.workingDir = ''
+        self.limits = None
+        self.status = STATUS_FINISHED
+        self.student = False
+
+    def run(self):
+        """
+        Invokes Popen with the process and arguments specified in procName and
+        procArgs.
+
+        Note
+        ----
+        This does not pipe stdout, stdin, or stderr, nor does it give the return
+        code from the process. 
+        """
+        if asyncRunner is not None:
+            asyncRunner.run(self.runAsync())
+            return
+
+        proc = Popen([self.procName] + self.procArgs,
+                cwd = self.workingDir or None)
+        proc.communicate()
+
+    async def runAsync(self):
+        """
+        The asyncio version of run.
+        """
+        async with asyncRunner.slot(self.student):
+            proc = await asyncio.create_subprocess_exec(self.procName,
+                    *self.procArgs, cwd = self.workingDir or None)
+            await proc.wait()
+
+    def setLimits(self, pid = 0):
+        """
+        Applies the CPU and memory limits to a process.
+
+        Parameters
+        ----------
+        pid:
+            The id of the process to limit. If 0, the limits are applied to the
+            calling process, which is how they are set in the child when
+            prlimit is not available.
+        """
+        rlimits = []
+        if self.limits.cpu:
+            cpu = int(self.limits.cpu)
+            rlimits.append((resource.RLIMIT_CPU, (cpu, cpu + 1)))
+        if self.limits.memory:
+            memory = int(self.limits.memory)
+            rlimits.append((resource.RLIMIT_AS, (memory, memory)))
+
+        for res, value in rlimits:
+            if pid:
+                resource.prlimit(pid, res, value)
+            else:
+                resource.setrlimit(res, value)
+
+    def kill(self, proc):
+        """
+        Kills the given process along with any process it started.
+
+        Parameters
+        ----------
+        proc:
+            The Popen object of the process.
+        """
+        try:
+            if os.name == 'posix':
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except OSError:
+            pass
+
+    def runPiped(self, input = None):
+        """
+        Invokes Popen with the process and arguments specified in procName and
+        procArgs with pipes.
+
+        This function captures stdout, stderr, and stdin for the process and
+        returns them (in raw byte string form) along with the return code. If
+        the process breaks any of its limits it is killed, and status records
+        the reason.
+
+        Parameters
+        ----------
+        input:
+            The input for the process (if any).
+        """
+        procOut = io.BytesIO()
+        procErr = io.BytesIO()
+        program = os.path.basename(self.procName)
+        with traceSpan('process', program = program):
+            procCode = self.execute(procOut, procErr, input)
+        return procOut.getvalue(), procErr.getvalue(), procCode
+
+    def execute(self, stdout, stderr, input = None):
+        """
+        Invokes Popen with the process and arguments specified in procName and
+        procArgs, streaming its output into the given objects.
+
+        The pipes are read in chunks, and each chunk is passed to the write
+        method of stdout or stderr as soon as it arrives, so the output never
+        has to be held in memory all at once. If the process breaks any of its
+        limits it is killed, and status records the reason.
+
+        Parameters
+        ----------
+        stdout:
+            The object that receives the chunks written to stdout.
+        stderr:
+            The object that receives the chunks written to stderr.
+        input:
+            The input for the process (if any).
+
+        Returns
+        -------
+            The return code of the process.
+        """
+        if asyncRunner is not None:
+            return asyncRunner.run(self.executeAsync(stdout, stderr, input))
+
+        limits = self.limits or Limits()
+        self.status = STATUS_FINISHED
+
+        # The CPU and memory limits are set through prlimit once the process
+        # has started, since preexec_fn is not safe to use when the marker
+        # runs submissions from several threads.
+        limited = resource is not None and (limits.cpu or limits.memory)
+        usePrlimit = limited and hasattr(resource, 'prlimit')
+        preexec = self.setLimits if limited and not usePrlimit else None
+
+        proc = Popen([self.procName] + self.procArgs, stdout = PIPE, stdin =
+                PIPE, stderr = PIPE, cwd = self.workingDir or None,
+                start_new_session = os.name == 'posix', preexec_fn = preexec)
+        if usePrlimit:
+            try:
+                self.setLimits(proc.pid)
+            except OSError:
+                pass
+
+        lock = threading.Lock()
+        captured = [0]
+        lastErr = [b'']
+
+        def readPipe(pipe, sink):
+            for chunk in iter(lambda: pipe.read1(CHUNK_SIZE), b''):
+                with lock:
+                    if limits.output and captured[0] + len(chunk) > \
+                            limits.output:
+                        chunk = chunk[:limits.output - captured[0]]
+                        captured[0] = limits.output
+                        self.status = STATUS_OUTPUT
+                        self.kill(proc)
+                    else:
+                        captured[0] += len(chunk)
+                sink.write(chunk)
+                if sink is stderr:
+                    lastErr[0] = (lastErr[0] + chunk)[-CHUNK_SIZE:]
+                if self.status == STATUS_OUTPUT:
+                    break
+            pipe.close()
+
+        def writePipe():
+            try:
+                if input:
+                    proc.stdin.write(input)
+                proc.stdin.close()
+            except OSError:
+                pass
+
+        threads = [threading.Thread(target = readPipe, args = (proc.stdout,
+            stdout)), threading.Thread(target = readPipe, args = (proc.stderr,
+                stderr)), threading.Thread(target = writePipe)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            proc.wait(timeout = limits.timeout or None)
+        except TimeoutExpired:
+            self.status = STATUS_TIMEOUT
+            self.kill(proc)
+            proc.wait()
+
+        # If the pipes are still open, the program left something running that
+        # holds them, so stop it too.
+        for thread in threads:
+            thread.join(timeout = 1)
+            if thread.is_alive():
+                self.kill(proc)
+                thread.join()
+
+        procCode = proc.returncode
+        self.checkStatus(limits, procCode, lastErr[0])
+        return procCode
+
+    async def executeAsync(self, stdout, stderr, input = None):
+        """
+        The asyncio version of execute.
+
+        A student program waits for its turn on the runner before it starts,
+        and the pipes of the process are read by the event loop.
+
+        Parameters
+        ----------
+        stdout:
+            The object that receives the chunks written to stdout.
+        stderr:
+            The object that receives the chunks written to stderr.
+        input:
+            The input for the process (if any).
+
+        Returns
+        -------
+            The return code of the process.
+        """
+        limits = self.limits or Limits()
+        self.status = STATUS_FINISHED
+
+        limited = resource is not None and (limits.cpu or limits.memory)
+        usePrlimit = limited and hasattr(resource, 'prlimit')
+        preexec = self.setLimits if limited and not usePrlimit else None
+
+        async with asyncRunner.slot(self.student):
+            proc = await asyncio.create_subprocess_exec(self.procName,
+                    *self.procArgs, stdout = PIPE, stdin = PIPE, stderr = PIPE,
+                    cwd = self.workingDir or None,
+                    start_new_session = os.name == 'posix',
+                    preexec_fn = preexec)
+            if usePrlimit:
+                try:
+                    self.setLimits(proc.pid)
+                except OSError:
+                    pass
+
+            # The loop runs one reader at a time, so no lock is needed.
+            captured = [0]
+            lastErr = [b'']
+
+            async def readPipe(stream, sink):
+                while True:
+                    chunk = await stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if limits.output and captured[0] + len(chunk) > \
+                            limits.output:
+                        chunk = chunk[:limits.output - captured[0]]
+                        captured[0] = limits.output
+                        self.status = STATUS_OUTPUT
+                        self.kill(proc)
+                    else:
+                        captured[0] += len(chunk)
+                    sink.write(chunk)
+                    if sink is stderr:
+                        lastErr[0] = (lastErr[0] + chunk)[-CHUNK_SIZE:]
+                    if self.status == STATUS_OUTPUT:
+                        break
+
+            async def writePipe():
+                try:
+                    if input:
+                        proc.stdin.write(input)
+                        await proc.stdin.drain()
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+            pipes = asyncio.ensure_future(asyncio.gather(
+                readPipe(proc.stdout, stdout), readPipe(proc.stderr, stderr),
+                writePipe()))
+
+            # asyncio only reports the exit of a process once its pipes are
+            # closed, so the return code is polled in case something the
+            # program started keeps them open.
+            async def waitExit():
+                while proc.returncode is None:
+                    await asyncio.sleep(0.01)
+
+            # Every wait below shares one deadline, so the program cannot get
+            # more time by closing its pipes before it exits.
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + limits.timeout if limits.timeout else None
+            def remaining():
+                if deadline is None:
+                    return None
+                return max(0, deadline - loop.time())
+
+            exited = asyncio.ensure_future(waitExit())
+            done, pending = await asyncio.wait([pipes, exited],
+                    timeout = remaining(),
+                    return_when = asyncio.FIRST_COMPLETED)
+            exited.cancel()
+            if not done:
+                self.status = STATUS_TIMEOUT
+                self.kill(proc)
+            elif proc.returncode is None:
+                try:
+                    await asyncio.wait_for(proc.wait(), remaining())
+                except asyncio.TimeoutError:
+                    self.status = STATUS_TIMEOUT
+                    self.kill(proc)
+
+            # If the pipes are still open, the program left something running
+            # that holds them, so stop it too.
+            done, pending = await asyncio.wait([pipes], timeout = 1)
+            if pending:
+                self.kill(proc)
+                await pipes
+            await proc.wait()
+
+        procCode = proc.returncode
+        self.checkStatus(limits, procCode, lastErr[0])
+        return procCode
+
+    def checkStatus(self, limits, procCode, lastErr):
+        """
+        Works out whether a process that failed was stopped by its CPU or
+        memory limit, and updates status.
+
+        Parameters
+        ----------
+        limits:
+            The limits the process was run with.
+        procCode:
+            The return code of the process.
+        lastErr:
+            The last bytes the process wrote to stderr.
+        """
+        if self.status == STATUS_FINISHED and procCode != 0:
+            signals = [getattr(signal, name, None) for name in ['SIGKILL',
+                'SIGXCPU']]
+            if limits.cpu and -procCode in signals:
+                self.status = STATUS_CPU
+            elif b'MemoryError' in lastErr:
+                self.status = STATUS_MEMORY
+
+class Capture:
+    """
+    Collects the output of a process within a bounded amount of memory.
+
+    By default everything is kept in memory. If a head or tail size is set,
+    only the first head bytes and the last tail bytes are kept in memory and
+    the full stream is spilled to an anonymous temporary file, from which it
+    can still be read back line by line.
+
+    Attributes
+    ----------
+    head:
+        The number of bytes kept from the start of the output.
+    tail:
+        The number of bytes kept from the end of the output.
+    size:
+        The total number of bytes written so far.
+    hash:
+        The running SHA-1 hash of everything written so far.
+    """
+    def __init__(self, head = 0, tail = 0, spillDir = None):
+        self.head = head
+        self.tail = tail
+        self.size = 0
+        self.hash = hashlib.sha1()
+        self.start = bytearray()
+        self.end = bytearray()
+        self.spill = None
+        if head or tail:
+            self.spill = tempfile.TemporaryFile(dir = spillDir)
+
+    def write(self, chunk):
+        """
+        Adds a chunk of output.
+
+        Parameters
+        ----------
+        chunk:
+            The raw bytes to add.
+        """
+        self.size += len(chunk)
+        self.hash.update(chunk)
+        if self.spill is None:
+            self.start += chunk
+            return
+
+        self.spill.write(chunk)
+        if len(self.start) < self.head:
+            room = self.head - len(self.start)
+            self.start += chunk[:room]
+            chunk = chunk[room:]
+
+        if self.tail:
+            self.end += chunk
+            del self.end[:-self.tail]
+
+    def decode(self, bytes):
+        """
+        Decodes raw output the same way the markers decode process output.
+
+        Parameters
+        ----------
+        bytes:
+            The bytes to decode.
+
+        Returns
+        -------
+            The decoded string.
+        """
+        return bytes.decode('utf-8', 'backslashreplace').replace('\r\n', '\n')
+
+    def splitLines(self, text):
+        """
+        Splits decoded output into lines, so the output is split the same way
+        whether it was kept in memory or spilled.
+
+        Parameters
+        ----------
+        text:
+            The decoded output.
+
+        Returns
+        -------
+            The list of lines, each including its line ending.
+        """
+        return text.replace('\r\n', '\n').splitlines(keepends = True)
+
+    def lines(self):
+        """
+        Iterates over the decoded lines of the full output.
+
+        Returns
+        -------
+            A generator of lines, each including its line ending.
+        """
+        if self.spill is None:
+            yield from self.splitLines(self.decode(bytes(self.start)))
+            return
+
+        # The spill file is read in chunks, and the last line of each chunk is
+        # held back since it may go on in the next one.
+        self.spill.flush()
+        self.spill.seek(0)
+        decoder = codecs.getincrementaldecoder('utf-8')('backslashreplace')
+        pending = ''
+        for chunk in iter(lambda: self.spill.read(CHUNK_SIZE), b''):
+            lines = self.splitLines(pending + decoder.decode(chunk))
+            pending = lines.pop() if lines else ''
+            yield from lines
+        yield from self.splitLines(pending + decoder.decode(b'', True))
+
+    def close(self):
+        """
+        Removes the spill file, if any.
+        """
+        if self.spill is not None:
+            self.spill.close()
+
+    def __str__(self):
+        """
+        Decodes the kept output. If part of it was dropped, the head and tail
+        are separated by a note saying how much is missing.
+        """
+        omitted = self.size - len(self.start) - len(self.end)
+        if self.spill is None or omitted <= 0:
+            return self.decode(bytes(self.start + self.end))
+
+        return '{}\n... {} bytes omitted ...\n{}'.format(
+                self.decode(bytes(self.start)), omitted,
+                self.decode(bytes(self.end)))
+
+class Comparator:
+    """
+    Compares the output of a program against the master output.
+
+    The comparison is done in tiers so that the common case of a correct
+    program stays cheap: the raw bytes are compared through their hashes
+    first, then the decoded lines are compared one at a time, and only if
+    they differ is the full diff computed.
+
+    Before the lines are compared, both outputs can be normalized with any of
+    the NORMALIZE_ modes:
+
+    * trailing: trailing whitespace on each line is ignored.
+    * blank: runs of blank lines count as one, and blank lines at the end
+      are ignored.
+    * case: letters are compared without regard to case.
+    * float: numbers are equal if they are within tolerance of each other.
+    * token: lines are compared as sequences of whitespace separated tokens.
+
+    Attributes
+    ----------
+    maxHunks:
+        The maximum number of differing blocks included in the diff. If 0,
+        the diff is not capped.
+    modes:
+        The normalization modes applied to every output.
+    tolerance:
+        The largest difference between two numbers that are considered equal
+        by the float mode.
+    outputModes:
+        The normalization modes of specific outputs, which replace modes. The
+        keys are the lower case names of the outputs up to the first dot, so
+        they also cover the outputs of test cases.
+    digests:
+        The size and hash of each master output file, computed on first use.
+    """
+    def __init__(self):
+        self.maxHunks = 0
+        self.modes = []
+        self.tolerance = 1e-6
+        self.outputModes = {}
+        self.digests = {}
+
+    def digest(self, path):
+        """
+        Computes the size and hash of a master output file.
+
+        Parameters
+        ----------
+        path:
+            The path to the file.
+
+        Returns
+        -------
+            The size of the file in bytes and its SHA-1 hash.
+        """
+        if path not in self.digests:
+            hash = hashlib.sha1()
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    hash.update(chunk)
+            self.digests[path] = (os.path.getsize(path), hash.hexdigest())
+        return self.digests[path]
+
+    def getModes(self, expected):
+        """
+        Finds the normalization modes for the given master output.
+
+        Parameters
+        ----------
+        expected:
+            The path to the master output file.
+
+        Returns
+        -------
+            The list of normalization modes.
+        """
+        name = os.path.basename(expected).split('.')[0].lower()
+        return self.outputModes.get(name, self.modes)
+
+    def normalize(self, lines, modes):
+        """
+        Normalizes lines as they are read, without holding more than one.
+
+        Parameters
+        ----------
+        lines:
+            The iterable of lines to normalize.
+        modes:
+            The normalization modes to apply.
+
+        Returns
+        -------
+            A generator of the normalized lines, each paired with the line as
+            it was read. A run of blank lines collapsed into one is paired with
+            the first line of the run.
+        """
+        blank = None
+        for raw in lines:
+            line = raw
+            if NORMALIZE_TOKEN in modes:
+                line = ' '.join(line.split()) + '\n'
+            elif NORMALIZE_TRAILING in modes:
+                line = line.rstrip() + '\n'
+            if NORMALIZE_CASE in modes:
+                line = line.casefold()
+
+            if NORMALIZE_BLANK in modes:
+                if not line.strip():
+                    if blank is None:
+                        blank = raw
+                    continue
+                if blank is not None:
+                    yield '\n', blank
+                    blank = None
+            yield line, raw
+
+    def match(self, a, b, modes):
+        """
+        Checks whether two normalized lines are equal.
+
+        Parameters
+        ----------
+        a:
+            The first line.
+        b:
+            The second line.
+        modes:
+            The normalization modes in use.
+
+        Returns
+        -------
+            True if the lines are equal, False otherwise.
+        """
+        if a == b:
+            return True
+        if NORMALIZE_FLOAT not in modes or a is None or b is None:
+            return False
+
+        tokensA = a.split()
+        tokensB = b.split()
+        if len(tokensA) != len(tokensB):
+            return False
+        for x, y in zip(tokensA, tokensB):
+            if x == y:
+                continue
+            try:
+                if not math.isclose(float(x), float(y), rel_tol = 0,
+                        abs_tol = self.tolerance):
+                    return False
+            except ValueError:
+                return False
+        return True
+
+    def compare(self, expected, ans):
+        """
+        Compares the output of a program against the master output.
+
+        Parameters
+        ----------
+        expected:
+            The path to the master output file.
+        ans:
+            The Capture holding the output of the program.
+
+        Returns
+        -------
+            0 if the outputs differ, 1 otherwise. It will also return the
+            results of the diff.
+        """
+        if ans.size == 0:
+            return 0, []
+
+        if self.digest(expected) == (ans.size, ans.hash.hexdigest()):
+            return 1, []
+
+        modes = self.getModes(expected)
+        with open(expected, 'r') as file:
+            pairs = zip_longest(self.normalize(file, modes),
+                    self.normalize(ans.lines(), modes), fillvalue = (None,
+                        None))
+            if all(self.match(a[0], b[0], modes) for a, b in pairs):
+                return 1, []
+
+            file.seek(0)
+            master = list(self.normalize(file, modes))
+        student = list(self.normalize(ans.lines(), modes))
+
+        # Lines that only differ by numbers within the tolerance should not
+        # show up in the diff, so they are compared as the master line.
+        if NORMALIZE_FLOAT in modes:
+            for i, (a, b) in enumerate(zip(master, student)):
+                if a[0] != b[0] and self.match(a[0], b[0], modes):
+                    student[i] = a[0], b[1]
+        return 0, self.makeDiff(master, student)
+
+    def makeDiff(self, master, student):
+        """
+        Computes the diff between two lists of lines, with hints for the
+        changes within each line.
+
+        Lines are matched by their normalized form, but the diff shows them as
+        they were printed. If maxHunks is set, the diff stops after that many
+        blocks of differing lines, which saves computing the rest of it.
+
+        Parameters
+        ----------
+        master:
+            The normalized lines of the master output, each paired with the
+            line as it was read.
+        student:
+            The normalized lines of the output of the program, paired in the
+            same way.
+
+        Returns
+        -------
+            The list of lines of the diff.
+        """
+        diff = []
+        hunks = 0
+        changed = False
+        for line in self.diffLines(master, student):
+            if line.startswith('  '):
+                changed = False
+            elif not changed:
+                changed = True
+                hunks += 1
+                if self.maxHunks and hunks > self.maxHunks:
+                    diff.append('... further differences omitted ...\n')
+                    break
+            diff.append(line)
+        return diff
+
+    def diffLines(self, master, student):
+        """
+        Compares the normalized lines and yields the diff of the lines as they
+        were read, in the format of difflib.Differ.
+
+        Parameters
+        ----------
+        master:
+            The pairs of normalized and read lines of the master output.
+        student:
+            The pairs of normalized and read lines of the output of the
+            program.
+
+        Returns
+        -------
+            A generator of the lines of the diff.
+        """
+        matcher = difflib.SequenceMatcher(None, [line for line, raw in master],
+                [line for line, raw in student])
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                for line, raw in student[j1:j2]:
+                    yield '  ' + raw
+            elif tag == 'delete':
+                for line, raw in master[i1:i2]:
+                    yield '- ' + raw
+            elif tag == 'insert':
+                for line, raw in student[j1:j2]:
+                    yield '+ ' + raw
+            else:
+                yield from difflib.Differ().compare(
+                        [raw for line, raw in master[i1:i2]],
+                        [raw for line, raw in student[j1:j2]])
+
+class TestCase:
+    """
+    A single input and expected output for a program.
+
+    Attributes
+    ----------
+    program:
+        The lower case name of the program the test case is for.
+    name:
+        The name of the test case.
+    input:
+        The path to the input file. Empty if the program takes no input.
+    output:
+        The path to the expected output. Empty if the output is not checked.
+    """
+    def __init__(self):
+        self.program = ''
+        self.name = ''
+        self.input = ''
+        self.output = ''
+
+def findTestCases(directory):
+    """
+    Finds the test cases in a directory.
+
+    Test cases are made of files called name.N.in and name.N.out, where name
+    is the name of the program and N is the number of the test case. Either
+    of the two files may be left out.
+
+    Parameters
+    ----------
+    directory:
+        The directory containing the test cases.
+
+    Returns
+    -------
+        A dictionary from the lower case name of each program to the list of
+        its test cases, in order of their number.
+    """
+    cases = {}
+    for entry in os.scandir(directory):
+        parts = entry.name.split('.')
+        if not entry.is_file() or len(parts) != 3:
+            continue
+        name, number, ext = parts
+        if ext not in ['in', 'out'] or not number.isdigit():
+            continue
+
+        key = (name.lower(), int(number))
+        if key not in cases:
+            cases[key] = TestCase()
+            cases[key].program = name.lower()
+            cases[key].name = '{}.{}'.format(name, number)
+        if ext == 'in':
+            cases[key].input = entry.path
+        else:
+            cases[key].output = entry.path
+
+    tests = {}
+    for key in sorted(cases):
+        tests.setdefault(key[0], []).append(cases[key])
+    return tests
+
+def digestFile(path):
+    """
+    Computes the SHA-256 hash of the contents of a file.
+
+    Parameters
+    ----------
+    path:
+        The path to the file.
+
+    Returns
+    -------
+        The hash, as a hex string.
+    """
+    hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+def listSubmission(subPath):
+    """
+    Finds the files of a submission and computes their hashes.
+
+    Parameters
+    ----------
+    subPath:
+        The path to the submitted files.
+
+    Returns
+    -------
+        A dictionary from the name of each file to its hash.
+    """
+    return {entry.name: digestFile(entry.path) for entry in
+            os.scandir(subPath) if entry.is_file()}
+
+def hashSubmission(subPath, files, extension, normalize, archive = None):
+    """
+    Hashes the files of a submission so that submissions that only differ in
+    the comments and whitespace of their sources get the same hash.
+
+    Parameters
+    ----------
+    subPath:
+        The path to the submitted files.
+    files:
+        A dictionary from the name of each file to its hash, as returned by
+        listSubmission. If None, the files are found in subPath.
+    extension:
+        The extension of the source files.
+    normalize:
+        The function that strips comments and whitespace from the text of a
+        source file.
+    archive:
+        The Archive holding the submission. If set, subPath is the directory
+        of the submission inside the archive, and files cannot be None.
+
+    Returns
+    -------
+        The hash of the submission, or None if its files cannot be read.
+    """
+    hash = hashlib.sha256()
+    try:
+        if files is None:
+            files = listSubmission(subPath)
+        for name in sorted(files):
+            digest = files[name]
+            if name.endswith(extension):
+                if archive is not None:
+                    data = archive.read(posixpath.join(subPath, name))
+                else:
+                    with open(os.path.join(subPath, name), 'rb') as file:
+                        data = file.read()
+                data = normalize(data.decode('utf-8', 'replace'))
+                digest = hashlib.sha256(data.encode('utf-8')).hexdigest()
+            hash.update(name.encode('utf-8') + b'\0')
+            hash.update(digest.encode('ascii') + b'\0')
+    except OSError:
+        return None
+    return hash.hexdigest()
+
+class Archive:
+    """
+    A zip archive used as the root of the assignments, as exported by the LMS.
+
+    Members are read on demand instead of extracting the archive. The archive
+    itself is never changed, so the files written for the root (the comments
+    and grades) go to a new archive with the same layout.
+
+    The archive is opened on first use, so it can be sent to worker processes,
+    each of which opens its own handle.
+
+    Attributes
+    ----------
+    path:
+        The path to the archive.
+    outputPath:
+        The path to the archive the comments and grades are written to.
+    prefix:
+        The directory inside the archive holding the student directories.
+        Found when the archive is opened.
+    zip:
+        The open ZipFile of the archive. None until the archive is first used.
+    output:
+        The open ZipFile of the output archive. None until it is written to.
+    lock:
+        Guards the output archive, since the exporters run at the same time.
+    """
+    def __init__(self):
+        self.path = ''
+        self.outputPath = ''
+        self.prefix = ''
+        self.zip = None
+        self.output = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Leaves the open archives out when the archive is sent to another
+        process.
+        """
+        state = self.__dict__.copy()
+        state['zip'] = None
+        state['output'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        Opens the archive if needed and finds the directory holding the
+        student directories.
+
+        Returns
+        -------
+            The ZipFile of the archive.
+        """
+        with self.lock:
+            if self.zip is None:
+                self.zip = zipfile.ZipFile(self.path)
+                for member in self.zip.namelist():
+                    parts = member.split('/')
+                    if SUBMISSION_DIR in parts[1:]:
+                        index = parts.index(SUBMISSION_DIR)
+                        self.prefix = '/'.join(parts[:index - 1])
+                        break
+        return self.zip
+
+    def read(self, member):
+        """
+        Reads a member of the archive.
+
+        Parameters
+        ----------
+        member:
+            The name of the member.
+
+        Returns
+        -------
+            The contents of the member.
+        """
+        return self.open().read(member)
+
+    def extract(self, member, dest):
+        """
+        Streams a member of the archive into a file.
+
+        Parameters
+        ----------
+        member:
+            The name of the member.
+        dest:
+            The path to the file to write.
+        """
+        with self.open().open(member) as src, open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+    def write(self, name, data):
+        """
+        Writes a file to the output archive.
+
+        Parameters
+        ----------
+        name:
+            The path of the file relative to the root, with forward slashes.
+        data:
+            The contents of the file.
+        """
+        self.open()
+        with self.lock:
+            if self.output is None:
+                self.output = zipfile.ZipFile(self.outputPath, 'w',
+                        zipfile.ZIP_DEFLATED)
+            self.output.writestr(posixpath.join(self.prefix, name), data)
+
+    def close(self):
+        """
+        Closes the archive and finishes writing the output archive.
+        """
+        with self.lock:
+            if self.zip is not None:
+                self.zip.close()
+                self.zip = None
+            if self.output is not None:
+                self.output.close()
+                self.output = None
+
+class Manifest:
+    """
+    The list of student directories under the root, with the name, size,
+    modification time, and hash of every submitted file.
+
+    The root is scanned once per session, with the student directories read
+    concurrently, and the manifest is saved so later sessions only have to
+    hash the files that changed since. Later stages use the
+    manifest instead of listing the directories again. If the root is an
+    Archive, the listing comes from the archive directory, and only members
+    whose size, time, or CRC changed are hashed again.
+
+    Attributes
+    ----------
+    path:
+        The path the manifest is saved to.
+    root:
+        The root directory that was scanned.
+    students:
+        The entry of each student directory, in the order they were found. An
+        entry holds the modification time of the submission directory and the
+        size, modification time, and hash of each file (and for archives, the
+        CRC of each member). It is None if the student has no submission
+        directory.
+    """
+    def __init__(self):
+        self.path = ''
+        self.root = ''
+        self.students = {}
+
+    def load(self):
+        """
+        Loads the manifest from path. A missing or unreadable manifest is
+        treated as empty.
+        """
+        try:
+            with open(self.path, 'r', encoding = 'utf-8') as file:
+                data = json.load(file)
+            self.root = data['root']
+            self.students = data['students']
+        except (OSError, ValueError, KeyError):
+            self.root = ''
+            self.students = {}
+
+    def save(self):
+        """
+        Saves the manifest to path, replacing the old one at once.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tempPath = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding = 'utf-8') as file:
+                json.dump({'root': self.root, 'students': self.students}, file)
+            os.replace(tempPath, self.path)
+        except:
+            os.remove(tempPath)
+            raise
+
+    def scan(self, root, archive = None):
+        """
+        Updates the manifest with the current contents of a root directory.
+
+        Only submissions whose directory has a different modification time
+        than in the manifest are listed again, since adding or removing a file
+        changes it. Every file is still checked, as a file written over in
+        place does not, and only the files whose size or modification time
+        changed are hashed again.
+
+        Parameters
+        ----------
+        root:
+            The root directory of the assignments.
+        archive:
+            The Archive of the root, if the root is a zip archive.
+        """
+        old = self.students if self.root == root else {}
+        if archive is not None:
+            self.scanArchive(archive, old)
+            self.root = root
+            return
+
+        def scanStudent(entry):
+            subPath = os.path.join(entry.path, SUBMISSION_DIR)
+            try:
+                mtime = os.stat(subPath).st_mtime_ns
+            except OSError:
+                return entry.name, None
+
+            previous = old.get(entry.name)
+            if previous is not None and previous['mtime'] == mtime:
+                names = list(previous['files'])
+            else:
+                names = [file.name for file in os.scandir(subPath) if
+                        file.is_file()]
+
+            files = {}
+            for name in names:
+                path = os.path.join(subPath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                known = previous['files'].get(name) if previous else None
+                if known is not None and known['size'] == stat.st_size and \
+                        known['mtime'] == stat.st_mtime_ns:
+                    files[name] = known
+                    continue
+                files[name] = {'size': stat.st_size,
+                        'mtime': stat.st_mtime_ns,
+                        'hash': digestFile(path)}
+            return entry.name, {'mtime': mtime, 'files': files}
+
+        entries = [entry for entry in os.scandir(root) if entry.is_dir()]
+        with ThreadPoolExecutor() as pool:
+            self.students = dict(pool.map(scanStudent, entries))
+        self.root = root
+
+    def scanArchive(self, archive, old):
+        """
+        Updates the manifest from the directory of an archive.
+
+        Parameters
+        ----------
+        archive:
+            The Archive of the root.
+        old:
+            The student entries of the last scan.
+        """
+        zip = archive.open()
+        depth = len(archive.prefix.split('/')) if archive.prefix else 0
+        # Student directories are the ones with members below them, and have
+        # a submission if any member is inside their submission directory.
+        members = {}
+        submitted = set()
+        for info in zip.infolist():
+            parts = info.filename.split('/')[depth:]
+            if len(parts) < 2 or not parts[0]:
+                continue
+            members.setdefault(parts[0], [])
+            if parts[1] != SUBMISSION_DIR:
+                continue
+            submitted.add(parts[0])
+            if len(parts) == 3 and not info.is_dir():
+                members[parts[0]].append(info)
+
+        def scanStudent(name):
+            if name not in submitted:
+                return name, None
+            infos = members[name]
+
+            previous = old.get(name) or {'files': {}}
+            files = {}
+            for info in infos:
+                file = info.filename.rsplit('/', 1)[1]
+                known = previous['files'].get(file)
+                entry = {'size': info.file_size,
+                        'mtime': list(info.date_time), 'crc': info.CRC}
+                if known is not None and all(known.get(key) == value for
+                        key, value in entry.items()):
+                    files[file] = known
+                    continue
+                hash = hashlib.sha256()
+                with zip.open(info) as src:
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                        hash.update(chunk)
+                entry['hash'] = hash.hexdigest()
+                files[file] = entry
+            return name, {'mtime': None, 'files': files}
+
+        with ThreadPoolExecutor() as pool:
+            self.students = dict(pool.map(scanStudent, members))
+
+    def files(self, name):
+        """
+        Gets the hashes of the files of a student.
+
+        Parameters
+        ----------
+        name:
+            The name of the student directory.
+
+        Returns
+        -------
+            A dictionary from the name of each file to its hash, or None if the
+            student has no submission directory.
+        """
+        entry = self.students.get(name)
+        if entry is None:
+            return None
+        return {file: info['hash'] for file, info in entry['files'].items()}
+
+class TestResult:
+    """
+    The outcome of running a program on a single test case.
+
+    Attributes
+    ----------
+    test:
+        The TestCase that was run.
+    ran:
+        Whether the test case was run at all.
+    code:
+        The return code of the program.
+    status:
+        How the program ended (one of the STATUS_ values).
+    diffCode:
+        The result of the diff: 1 if the outputs match, 0 if they do not, and
+        -1 if no diff was performed.
+    diff:
+        The lines of the diff.
+    stdout:
+        The output of the program, kept only if it did not finish normally.
+    stderr:
+        The error output of the program, kept only if it did not finish
+        normally.
+    """
+    def __init__(self):
+        self.test = None
+        self.ran = False
+        self.code = 0
+        self.status = STATUS_FINISHED
+        self.diffCode = -1
+        self.diff = []
+        self.stdout = ''
+        self.stderr = ''
+
+    def passed(self):
+        """
+        Checks whether the test case passed.
+
+        Returns
+        -------
+            True if the program finished without errors and its output matched
+            (when there was an output to match), False otherwise.
+        """
+        return (self.ran and self.status == STATUS_FINISHED and self.code == 0
+                and self.diffCode != 0)
+
+    def describe(self, limits):
+        """
+        Describes the outcome of the test case for the summary.
+
+        Parameters
+        ----------
+        limits:
+            The Limits the program was run with.
+
+        Returns
+        -------
+            The text describing the outcome.
+        """
+        text = 'Test case {}: '.format(self.test.name)
+        if not self.ran:
+            return text + 'not run\n'
+        if self.passed():
+            return text + 'passed\n'
+
+        if self.status != STATUS_FINISHED:
+            text += 'failed\n{}\n'.format(limits.describe(self.status))
+        elif self.code != 0:
+            text += 'failed\nProgram return code: {}\n'.format(self.code)
+        elif self.diff:
+            return text + 'failed, outputs differ\n{}\n'.format(
+                    ''.join(self.diff))
+        else:
+            return text + 'failed, no output received from program\n'
+
+        text += 'stdout:\n{}\n'.format(self.stdout)
+        text += 'stderr:\n{}\n'.format(self.stderr)
+        return text
+
+class AutoRule:
+    """
+    Binds an element of the rubric to an outcome of a program.
+
+    The outcomes of a program are whether it compiled and the list of its
+    runs, one per test case or a single one if it has no test cases. The kinds
+    of rules are:
+        compile: the program compiled.
+        run: every run finished with a return code of 0.
+        diff: the output of every run matched the expected one.
+        test: the given test case passed.
+        tests: the marks are split between the test cases that passed.
+
+    Attributes
+    ----------
+    item:
+        The element of the rubric.
+    kind:
+        What the rule checks (one of the AUTO_ values).
+    program:
+        The lower case name of the program.
+    test:
+        The lower case name of the test case, for rules of the test kind.
+    marks:
+        The marks awarded when the outcome is met. If None, the maximum value
+        of the element is awarded.
+    """
+    def __init__(self):
+        self.item = ''
+        self.kind = AUTO_COMPILE
+        self.program = ''
+        self.test = ''
+        self.marks = None
+
+    def parse(self, item, text):
+        """
+        Reads the rule from the config file, written as the kind, the name of
+        the program (or of the test case), and optionally the marks.
+
+        Parameters
+        ----------
+        item:
+            The element of the rubric.
+        text:
+            The rule, such as "diff Test" or "test Test.2 0.5".
+
+        Raises
+        ------
+        ValueError:
+            If the rule cannot be read.
+        """
+        tokens = text.split()
+        if len(tokens) not in (2, 3) or tokens[0].lower() not in AUTO_KINDS:
+            raise ValueError('cannot read rule "{}" of {}'.format(text, item))
+
+        self.item = item
+        self.kind = tokens[0].lower()
+        target = tokens[1].lower()
+        if self.kind == AUTO_TEST:
+            self.program = target.rsplit('.', 1)[0]
+            self.test = target
+        else:
+            self.program = os.path.splitext(target)[0]
+        if len(tokens) == 3:
+            self.marks = float(tokens[2])
+
+    def describe(self):
+        """
+        Describes what the rule checks, for the comments.
+
+        Returns
+        -------
+            The description.
+        """
+        if self.kind == AUTO_TEST:
+            return 'test case {}'.format(self.test)
+        return '{} of {}'.format(self.kind, self.program)
+
+    def evaluate(self, outcome):
+        """
+        Checks the rule against the outcome of the program.
+
+        Parameters
+        ----------
+        outcome:
+            The outcome of the program, as written by runSubmission. If None,
+            the program was not submitted.
+
+        Returns
+        -------
+            The fraction of the marks earned, the reason for it, and whether
+            the outcome is unclear enough that a person should look at it.
+        """
+        if outcome is None:
+            return 0.0, 'the program was not submitted', True
+        if self.kind == AUTO_COMPILE:
+            if outcome['compiled']:
+                return 1.0, 'compiled', False
+            return 0.0, 'did not compile', False
+        if not outcome['compiled']:
+            return 0.0, 'did not compile', False
+
+        runs = outcome['runs']
+        if self.kind == AUTO_TEST:
+            runs = [run for run in runs if run['test'].lower() == self.test]
+            if not runs:
+                return 0.0, 'no such test case', True
+        elif self.kind == AUTO_TESTS:
+            runs = [run for run in runs if run['test']]
+            if not runs:
+                return 0.0, 'the program has no test cases', True
+
+        # A program stopped for going over a limit may have been unlucky with
+        # the load of the machine.
+        unclear = any(run['status'] != STATUS_FINISHED for run in runs)
+
+        if self.kind == AUTO_RUN:
+            good = [run for run in runs if run['ran'] and
+                    run['status'] == STATUS_FINISHED and run['code'] == 0]
+            if len(good) == len(runs):
+                return 1.0, 'ran without errors', unclear
+            return 0.0, 'ended with errors', unclear
+
+        passed = [run for run in runs if run['ran'] and
+                run['status'] == STATUS_FINISHED and run['code'] == 0 and
+                run['diff'] != 0]
+        if self.kind == AUTO_DIFF:
+            # Runs that finished but were not compared mean there is no
+            # expected output to compare against.
+            unclear = unclear or any(run['diff'] == -1 for run in passed)
+            if len(passed) == len(runs):
+                return 1.0, 'output matched', unclear
+            return 0.0, 'output did not match', unclear
+
+        fraction = len(passed) / len(runs)
+        return fraction, 'passed {} of {}'.format(len(passed), len(runs)), \
+                unclear
+
+class AutoGrader:
+    """
+    Marks students from the outcomes of their programs, following the rules
+    that bind elements of the rubric to outcomes.
+
+    Elements without a rule are left at 0 for the grader to fill in.
+
+    Attributes
+    ----------
+    rules:
+        The list of AutoRule.
+    review:
+        Which students are opened in the editor once they are marked (one of
+        the REVIEW_ values).
+    """
+    def __init__(self):
+        self.rules = []
+        self.review = REVIEW_AMBIGUOUS
+
+    def grade(self, schema, outcomes):
+        """
+        Marks a student.
+
+        Parameters
+        ----------
+        schema:
+            The RubricSchema of the rubric.
+        outcomes:
+            The outcomes of the programs of the student, keyed by the lower
+            case name of each program.
+
+        Returns
+        -------
+            The Rubric of the student, with the reason for each mark in the
+            comments, and whether the student should be opened in the editor.
+        """
+        rubric = Rubric(schema)
+        notes = []
+        ambiguous = False
+        for rule in self.rules:
+            maxVal = schema.maxVals[schema.index[rule.item]]
+            marks = maxVal if rule.marks is None else rule.marks
+            fraction, reason, unclear = rule.evaluate(outcomes.get(
+                rule.program))
+            rubric.setMark(rule.item, round(marks * fraction, 2))
+            notes.append('{}: {} ({})\n'.format(rule.item, reason,
+                rule.describe()))
+            ambiguous = ambiguous or unclear
+
+        rubric.comments = ''.join(notes)
+        review = self.review == REVIEW_ALL or (self.review == REVIEW_AMBIGUOUS
+                and ambiguous)
+        return rubric, review
+
+class Sandbox:
+    """
+    A private, temporary directory in which a single submission is run.
+
+    Instructor files are placed in the sandbox as reflinks when the filesystem
+    allows it, so setting up a sandbox does not copy their contents. Unlike a
+    hardlink, a reflink is a separate file, so a program that writes to it
+    leaves the original alone. The whole sandbox is removed in one call once
+    it is no longer needed.
+
+    Attributes
+    ----------
+    root:
+        The directory in which the sandbox is created.
+    path:
+        The path to the sandbox. Empty until the sandbox is created.
+    """
+    def __init__(self):
+        self.root = ''
+        self.path = ''
+
+    def create(self, prefix = ''):
+        """
+        Creates a new, empty sandbox directory inside root.
+
+        Parameters
+        ----------
+        prefix:
+            The prefix of the name of the sandbox directory.
+        """
+        self.path = tempfile.mkdtemp(prefix = prefix, dir = self.root or None)
+
+    def link(self, file):
+        """
+        Places the given file in the sandbox without copying it if possible.
+
+        This tries a reflink first and falls back to a regular copy if it is
+        not supported. Hardlinks are never used, since programs may write to
+        the files.
+
+        Parameters
+        ----------
+        file:
+            The path to the file to place in the sandbox.
+        """
+        dest = os.path.join(self.path, os.path.basename(file))
+        if fcntl is not None:
+            try:
+                with open(file, 'rb') as src, open(dest, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                shutil.copystat(file, dest)
+                return
+            except OSError:
+                if os.path.exists(dest):
+                    os.remove(dest)
+
+        shutil.copy2(file, dest)
+
+    def copy(self, file):
+        """
+        Copies the given file into the sandbox.
+
+        Parameters
+        ----------
+        file:
+            The path to the file to copy.
+        """
+        shutil.copy2(file, self.path)
+
+    def remove(self):
+        """
+        Removes the sandbox along with everything inside of it.
+        """
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors = True)
+
+class ResultCache:
+    """
+    A persistent store of the results of running submissions, so that
+    submissions that did not change are not run again in a later session.
+
+    Results are stored in a SQLite database and are keyed on the hash of the
+    files of the submission combined with a salt, which covers everything else
+    the result depends on: the instructor files, the pre-processing script, the
+    version of the toolchain, and the settings of the marker. When the results
+    take up more than maxSize bytes, the least recently used ones are evicted.
+
+    The database is opened on first use, so the cache can be sent to worker
+    processes, each of which opens its own connection.
 
     Attributes
     ----------
-    procName:
-        The name of the process (executable) to run.
-    procArgs: 
-        The list of arguments that the process specified in procArgs takes.
+    path:
+        The path to the database.
+    maxSize:
+        The total size of the stored results, in bytes, above which results
+        are evicted. If 0, results are never evicted.
+    salt:
+        The hash of everything besides the submission that results depend on.
+    connection:
+        The connection to the database. None until the cache is first used.
+    lock:
+        Guards the connection, since submissions may be run from several
+        threads.
     """
     def __init__(self):
-        self.procName = ''
-        self.procArgs = []
+        self.path = ''
+        self.maxSize = 0
+        self.salt = ''
+        self.connection = None
+        self.lock = threading.Lock()
 
-    def run(self):
+    def __getstate__(self):
         """
-        Invokes Popen with the process and arguments specified in procName and
-        procArgs.
+        Leaves the connection out when the cache is sent to another process,
+        which opens its own.
+        """
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['heartbeat'] = None
+        state['stopped'] = None
+        del state['lock']
+        return state
 
-        Note
-        ----
-        This does not pipe stdout, stdin, or stderr, nor does it give the return
-        code from the process. 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def open(self):
         """
-        proc = Popen([self.procName] + self.procArgs)
-        proc.communicate()
+        Opens the database, creating it if needed. Must be called with the lock
+        held.
+        """
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout = 30,
+                    check_same_thread = False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                    'key TEXT PRIMARY KEY, files TEXT, summary BLOB, '
+                    'size INTEGER, used REAL, outcomes BLOB)')
 
-    def runPiped(self, input = None):
+            # Databases written by earlier versions have no outcomes.
+            columns = [row[1] for row in self.connection.execute(
+                'PRAGMA table_info(results)')]
+            if 'outcomes' not in columns:
+                self.connection.execute('ALTER TABLE results ADD COLUMN '
+                        'outcomes BLOB')
+            self.connection.commit()
+        return self.connection
+
+    def hashFile(self, hash, path):
         """
-        Invokes Popen with the process and arguments specified in procName and
-        procArgs with pipes.
+        Adds the name and contents of a file to a hash.
 
-        This function captures stdout, stderr, and stdin for the process and
-        returns them (in raw byte string form) along with the return code.
+        Parameters
+        ----------
+        hash:
+            The hash object to update.
+        path:
+            The path to the file.
+        """
+        hash.update(os.path.basename(path).encode('utf-8') + b'\0')
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                hash.update(chunk)
+        hash.update(b'\0')
+
+    def setSalt(self, files, values):
+        """
+        Computes the salt of the cache.
 
         Parameters
         ----------
-        input:
-            The input for the process (if any).
+        files:
+            The list of files besides the submission that results depend on.
+            Files that do not exist are skipped.
+        values:
+            The list of strings describing the toolchain and settings that
+            results depend on.
         """
-        proc = Popen([self.procName] + self.procArgs, stdout = PIPE, stdin =
-                PIPE, stderr = PIPE)
-        procOut, procErr = proc.communicate(input)
-        procCode = proc.returncode
-        return procOut, procErr, procCode
+        hash = hashlib.sha256()
+        for value in values:
+            hash.update(str(value).encode('utf-8') + b'\0')
+        for file in sorted(files):
+            if os.path.isfile(file):
+                self.hashFile(hash, file)
+        self.salt = hash.hexdigest()
+
+    def makeKey(self, files):
+        """
+        Computes the key of a submission.
+
+        Parameters
+        ----------
+        files:
+            A dictionary from the name of each file of the submission to its
+            hash, as returned by listSubmission.
+
+        Returns
+        -------
+            The key of the submission.
+        """
+        hash = hashlib.sha256(self.salt.encode('utf-8'))
+        for name in sorted(files):
+            hash.update(name.encode('utf-8') + b'\0')
+            hash.update(files[name].encode('ascii') + b'\0')
+        return hash.hexdigest()
+
+    def get(self, key):
+        """
+        Looks up the result of a submission and marks it as recently used.
+
+        Parameters
+        ----------
+        key:
+            The key of the submission.
+
+        Returns
+        -------
+            The list of files for the editor, the contents of the summary, and
+            the contents of the outcomes, or None if the result is not stored.
+        """
+        with self.lock:
+            connection = self.open()
+            row = connection.execute('SELECT files, summary, outcomes FROM '
+                    'results WHERE key = ? AND outcomes IS NOT NULL',
+                    (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE results SET used = ? WHERE key = ?',
+                    (time.time(), key))
+            connection.commit()
+        return json.loads(row[0]), bytes(row[1]), bytes(row[2])
+
+    def put(self, key, files, summary, outcomes):
+        """
+        Stores the result of a submission, evicting old results if needed.
+
+        Parameters
+        ----------
+        key:
+            The key of the submission.
+        files:
+            The list of files for the editor.
+        summary:
+            The contents of the summary.
+        outcomes:
+            The contents of the outcomes of the programs.
+        """
+        with self.lock:
+            connection = self.open()
+            connection.execute('INSERT OR REPLACE INTO results (key, files, '
+                    'summary, size, used, outcomes) VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, json.dumps(files), summary,
+                        len(summary) + len(outcomes), time.time(), outcomes))
+            if self.maxSize:
+                total = connection.execute(
+                        'SELECT COALESCE(SUM(size), 0) FROM results'
+                        ).fetchone()[0]
+                rows = connection.execute('SELECT key, size FROM results '
+                        'ORDER BY used').fetchall()
+                for oldKey, size in rows:
+                    if total <= self.maxSize:
+                        break
+                    connection.execute('DELETE FROM results WHERE key = ?',
+                            (oldKey,))
+                    total -= size
+            connection.commit()
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
 
 class Config:
     """
@@ -70,6 +2221,17 @@ class Config:
     language:
         The language in which the assignments are written (currently one of
         Java or Python).
+    batch:
+        Whether all submissions are run before the marking starts.
+    workers:
+        The number of processes used to run submissions in batch mode.
+    lookahead:
+        The number of submissions run in the background while marking.
+    duplicates:
+        Whether submissions with the same code are run only once.
+    trace:
+        The file the spans of each stage are written to. If empty, nothing is
+        recorded.
     """
 
     def __init__(self):
@@ -78,6 +2240,28 @@ class Config:
         self.makeComments = False
         self.workingDir = ''
         self.language = ''
+        self.batch = False
+        self.workers = os.cpu_count()
+        self.lookahead = 0
+        self.duplicates = False
+        self.trace = ''
+
+def formatDuration(seconds):
+    """
+    Formats a number of seconds as hours, minutes, and seconds.
+
+    Parameters
+    ----------
+    seconds:
+        The number of seconds.
+
+    Returns
+    -------
+        The duration, as H:MM:SS.
+    """
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
 class Editor:
     """
@@ -110,50 +2294,645 @@ class Editor:
         proc = Process()
         proc.procName = self.cmd
         proc.procArgs = self.args + files
-        proc.run()
+        with traceSpan('editor'):
+            proc.run()
+
+class RubricSchema:
+    """
+    The items of the marking rubric and their maximum values.
+
+    The schema is shared by the rubrics of all the students, and cannot be
+    changed once it is made.
+
+    Attributes
+    ----------
+    items:
+        The names of the elements of the marking rubric, in order.
+    maxVals:
+        The maximum values of each element of the marking rubric.
+    index:
+        The position of each element in items.
+    """
+    __slots__ = ('items', 'maxVals', 'index')
+
+    def __init__(self, items = (), maxVals = ()):
+        object.__setattr__(self, 'items', tuple(items))
+        object.__setattr__(self, 'maxVals', array('d', maxVals))
+        object.__setattr__(self, 'index',
+                {item: i for i, item in enumerate(self.items)})
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RubricSchema is immutable')
+
+    def __getstate__(self):
+        return self.items, self.maxVals.tolist()
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @property
+    def total(self):
+        """
+        The maximum total mark.
+        """
+        return math.fsum(self.maxVals)
 
 class Rubric:
     """
-    Holds the grading rubric.
+    Holds the marks of a student for each element of the marking rubric.
 
     Attributes
     ----------
+    schema:
+        The RubricSchema the marks belong to.
     studentName:
         The name of the current student.
-    attributes:
-        The elements of the marking rubric.
-    maxVals:
-        The maximum values of each element of the marking rubric.
-    total:
-        The total mark for the student.
+    marks:
+        The mark of each element of the rubric, in the order of the schema.
     comments:
         The instructor's comments for the student.
     """
-    def __init__(self):
+    __slots__ = ('schema', 'studentName', 'marks', 'comments')
+
+    def __init__(self, schema = None):
+        self.schema = schema if schema is not None else RubricSchema()
         self.studentName = ''
-        self.attributes = {}
-        self.maxVals = []
-        self.total = 0
+        self.marks = array('d', [0.0]) * len(self.schema.items)
         self.comments = ''
 
-    def make(self, rubric):
+    @property
+    def total(self):
+        """
+        The total mark for the student.
+        """
+        return math.fsum(self.marks)
+
+    def setMark(self, item, mark):
+        """
+        Sets the mark of an element of the rubric.
+
+        Parameters
+        ----------
+        item:
+            The name of the element.
+        mark:
+            The mark of the student.
+
+        Raises
+        ------
+        KeyError:
+            If the element is not part of the rubric.
+        """
+        self.marks[self.schema.index[item]] = mark
+
+    def items(self):
+        """
+        Lists the elements of the rubric with their marks.
+
+        Returns
+        -------
+            An iterator over the name, mark, and maximum value of each element.
+        """
+        return zip(self.schema.items, self.marks, self.schema.maxVals)
+
+class GradeJournal:
+    """
+    An append-only record of the graded students, used to resume a marking
+    session.
+
+    Each graded student is written as one line of JSON, which is flushed to
+    disk before the next student is marked, so a crash can at most tear the
+    last line. Replaying the journal keeps the last record of each student.
+    Every compactEvery records, the journal is rewritten with one record per
+    student, into a new file that replaces the old one.
+
+    Attributes
+    ----------
+    path:
+        The path to the journal.
+    compactEvery:
+        The number of records appended between compactions. If 0, the
+        journal is never compacted.
+    records:
+        The last record of each student, in the order they were first graded.
+    appended:
+        The number of records appended since the last compaction.
+    """
+    def __init__(self):
+        self.path = ''
+        self.compactEvery = 100
+        self.records = {}
+        self.appended = 0
+
+    def makeRecord(self, rubric):
+        """
+        Converts the rubric of a student into a record.
+
+        Parameters
+        ----------
+        rubric:
+            The rubric of the student.
+
+        Returns
+        -------
+            The record, as a dictionary.
+        """
+        return {'student': rubric.studentName,
+                'marks': {item: mark for item, mark, maxVal in rubric.items()},
+                'comments': rubric.comments}
+
+    def makeRubric(self, record, schema):
+        """
+        Converts a record back into the rubric of a student.
+
+        Parameters
+        ----------
+        record:
+            The record, as a dictionary.
+        schema:
+            The RubricSchema of the rubric. Marks of items that are not in it
+            are dropped.
+
+        Returns
+        -------
+            The rubric of the student.
+        """
+        rubric = Rubric(schema)
+        rubric.studentName = record['student']
+        rubric.comments = record['comments']
+        for item, mark in record['marks'].items():
+            if item in schema.index:
+                rubric.setMark(item, mark)
+        return rubric
+
+    def load(self, schema):
+        """
+        Replays the journal.
+
+        A last record that was only partly written is dropped, and the journal
+        is compacted so that new records do not follow it.
+
+        Parameters
+        ----------
+        schema:
+            The RubricSchema of the rubrics.
+
+        Returns
+        -------
+            The list of rubrics of the graded students.
+        """
+        self.records = {}
+        self.appended = 0
+        if not os.path.isfile(self.path):
+            return []
+
+        torn = False
+        lines = 0
+        with open(self.path, 'rb') as file:
+            for line in file:
+                lines += 1
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    torn = True
+                    continue
+                self.records[record['student']] = record
+
+        if torn or lines != len(self.records):
+            self.compact()
+        return [self.makeRubric(record, schema) for record in
+                self.records.values()]
+
+    def migrate(self, csvPath, schema):
+        """
+        Moves the grades of an incremental CSV file, as written by earlier
+        versions, into the journal and removes the file.
+
+        Parameters
+        ----------
+        csvPath:
+            The path to the CSV file.
+        schema:
+            The RubricSchema of the rubrics.
+        """
+        with open(csvPath, 'r', newline = '') as inFile:
+            reader = csv.reader(inFile)
+            header = next(reader)
+            for line in reader:
+                rubric = Rubric(schema)
+                rubric.studentName = line[0]
+                for i in range(1, len(header) - 2):
+                    if header[i] in schema.index:
+                        rubric.setMark(header[i], float(line[i]))
+                rubric.comments = line[-1]
+                self.records[rubric.studentName] = self.makeRecord(rubric)
+
+        self.compact()
+        os.remove(csvPath)
+
+    def append(self, rubric):
+        """
+        Adds the rubric of a student to the journal and flushes it to disk.
+
+        Parameters
+        ----------
+        rubric:
+            The rubric of the student.
+        """
+        record = self.makeRecord(rubric)
+        self.records[rubric.studentName] = record
+        with open(self.path, 'ab') as file:
+            file.write(json.dumps(record).encode('utf-8') + b'\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.appended += 1
+        if self.compactEvery and self.appended >= self.compactEvery:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrites the journal with only the last record of each student.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tempPath = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for record in self.records.values():
+                    file.write(json.dumps(record).encode('utf-8') + b'\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tempPath, self.path)
+        except:
+            os.remove(tempPath)
+            raise
+
+        # Make sure the rename itself reaches the disk.
+        if hasattr(os, 'O_DIRECTORY'):
+            dirFd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
+        self.appended = 0
+
+class WorkQueue:
+    """
+    A queue of the students of a class shared by several markers, so a class
+    can be marked by more than one grader at a time.
+
+    The queue is a SQLite database, usually on a filesystem every marker can
+    reach. Each marker leases one student at a time, and the lease runs out
+    after leaseTime seconds so the students of a marker that stopped are picked
+    up by the others. The grades are recorded in the same database, from which
+    the comments and the CSV file are written once every student is marked.
+    SQLite relies on the locks of the filesystem, which some network
+    filesystems do not honour.
+
+    The database is opened on first use, so the queue can be sent to worker
+    processes, each of which opens its own connection.
+
+    Attributes
+    ----------
+    path:
+        The path to the database.
+    owner:
+        The name the leases of this marker are taken under.
+    leaseTime:
+        The number of seconds after which a lease runs out.
+    connection:
+        The connection to the database. None until the queue is first used.
+    lock:
+        Guards the connection.
+    heartbeat:
+        The thread renewing the leases of this marker, or None.
+    stopped:
+        Set to stop the heartbeat.
+    """
+    def __init__(self):
+        self.path = ''
+        self.owner = ''
+        self.leaseTime = 30 * 60
+        self.connection = None
+        self.lock = threading.Lock()
+        self.heartbeat = None
+        self.stopped = None
+
+    def __getstate__(self):
+        """
+        Leaves the connection out when the queue is sent to another process,
+        which opens its own.
+        """
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['heartbeat'] = None
+        state['stopped'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        Opens the database, creating it if needed. Must be called with the lock
+        held.
+
+        Transactions are begun by hand, so that a student is read and leased
+        without another marker leasing it in between.
+        """
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout = 30,
+                    check_same_thread = False, isolation_level = None)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS students ('
+                    'name TEXT PRIMARY KEY, owner TEXT, expires REAL, '
+                    'done INTEGER)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS grades ('
+                    'student TEXT PRIMARY KEY, record TEXT, owner TEXT, '
+                    'time REAL)')
+        return self.connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Holds the lock and the write lock of the database for a block of
+        statements, which are committed together.
+
+        Returns
+        -------
+            The connection.
+        """
+        with self.lock:
+            connection = self.open()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def add(self, names):
+        """
+        Adds students to the queue. Students that are already in it are left
+        as they are.
+
+        Parameters
+        ----------
+        names:
+            The names of the student directories.
+        """
+        with self.transaction() as connection:
+            connection.executemany('INSERT OR IGNORE INTO students (name, '
+                    'done) VALUES (?, 0)', [(name,) for name in names])
+
+    def reclaim(self):
+        """
+        Gives up the leases left by an earlier session of this marker, so the
+        students are marked again without waiting for the leases to run out.
+        """
+        with self.transaction() as connection:
+            connection.execute('UPDATE students SET owner = NULL, expires = '
+                    'NULL WHERE owner = ? AND done = 0', (self.owner,))
+
+    def lease(self):
+        """
+        Leases the next student nobody is marking.
+
+        Returns
+        -------
+            The name of the student, or None if every student is either marked
+            or leased by a marker.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute('SELECT name FROM students WHERE done = '
+                    '0 AND (owner IS NULL OR expires < ?) ORDER BY rowid '
+                    'LIMIT 1', (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE students SET owner = ?, expires = ? '
+                    'WHERE name = ?', (self.owner, now + self.leaseTime,
+                        row[0]))
+        return row[0]
+
+    def renew(self, name):
+        """
+        Extends the lease on a student.
+
+        Parameters
+        ----------
+        name:
+            The name of the student.
+
+        Returns
+        -------
+            False if the lease ran out and the student was leased by another
+            marker or marked already.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute('UPDATE students SET expires = ? '
+                    'WHERE name = ? AND owner = ? AND done = 0',
+                    (time.time() + self.leaseTime, name, self.owner))
+        return cursor.rowcount == 1
+
+    def renewAll(self):
+        """
+        Extends the leases on every student this marker holds, so that the
+        students leased ahead by the workers, and the one being edited, stay
+        with this marker however long it takes.
+        """
+        with self.transaction() as connection:
+            connection.execute('UPDATE students SET expires = ? WHERE owner = '
+                    '? AND done = 0', (time.time() + self.leaseTime,
+                        self.owner))
+
+    def startHeartbeat(self):
+        """
+        Starts a thread that renews the leases of this marker three times per
+        leaseTime, until stopHeartbeat is called.
+        """
+        self.stopped = threading.Event()
+        def beat():
+            while not self.stopped.wait(self.leaseTime / 3):
+                self.renewAll()
+        self.heartbeat = threading.Thread(target = beat, daemon = True)
+        self.heartbeat.start()
+
+    def stopHeartbeat(self):
+        """
+        Stops the thread started by startHeartbeat.
+        """
+        if self.heartbeat is not None:
+            self.stopped.set()
+            self.heartbeat.join()
+            self.heartbeat = None
+
+    def record(self, rubric):
         """
-        Performs a deep copy of the provided rubric.
+        Records the grade of a student and takes them off the queue. The grade
+        is only recorded if this marker holds the lease on the student, or
+        nobody does, so that a marker whose lease ran out cannot overwrite the
+        grade of the marker that took the student over.
 
         Parameters
         ----------
         rubric:
-            The source rubric to copy from.
+            The rubric of the student.
+
+        Returns
+        -------
+            False if the student is leased by or was marked by another marker,
+            in which case nothing is recorded.
+        """
+        record = GradeJournal().makeRecord(rubric)
+        with self.transaction() as connection:
+            cursor = connection.execute('UPDATE students SET owner = ?, '
+                    'expires = NULL, done = 1 WHERE name = ? AND done = 0 AND '
+                    '(owner = ? OR owner IS NULL)', (self.owner,
+                        rubric.studentName, self.owner))
+            if cursor.rowcount != 1:
+                return False
+            connection.execute('INSERT OR REPLACE INTO grades (student, '
+                    'record, owner, time) VALUES (?, ?, ?, ?)',
+                    (rubric.studentName, json.dumps(record), self.owner,
+                        time.time()))
+        return True
+
+    def finished(self):
+        """
+        Gets the students that are marked.
+
+        Returns
+        -------
+            The set of the names of the students.
+        """
+        with self.lock:
+            connection = self.open()
+            rows = connection.execute('SELECT name FROM students WHERE done '
+                    '= 1').fetchall()
+        return {row[0] for row in rows}
+
+    def remaining(self):
+        """
+        Counts the students that are not marked yet, including the ones that
+        are leased.
+
+        Returns
+        -------
+            The number of students.
+        """
+        with self.lock:
+            connection = self.open()
+            return connection.execute('SELECT COUNT(*) FROM students WHERE '
+                    'done = 0').fetchone()[0]
+
+    def grades(self, schema):
         """
-        self.studentName = rubric.studentName
-        self.attributes = deepcopy(rubric.attributes)
-        self.maxVals = deepcopy(rubric.maxVals)
-        self.total = rubric.total
-        self.comments = rubric.comments
+        Gathers the grades recorded by every marker.
 
-    def addMarks(self):
+        Parameters
+        ----------
+        schema:
+            The RubricSchema of the rubrics.
+
+        Returns
+        -------
+            The list of rubrics of the marked students.
+        """
+        with self.lock:
+            connection = self.open()
+            rows = connection.execute('SELECT record FROM grades ORDER BY '
+                    'time').fetchall()
+        journal = GradeJournal()
+        return [journal.makeRubric(json.loads(row[0]), schema) for row in
+                rows]
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+class GradeTable:
+    """
+    The rubrics of all the students, indexed so that exporters can find the
+    rubric of a student without searching the whole list.
+
+    Student directories are named "Last, First(id)", so rubrics can be found
+    either by the name of the directory or by the ID alone.
+
+    Attributes
+    ----------
+    byName:
+        The rubric of each student directory name.
+    byId:
+        The rubric of each student ID.
+    """
+    ID = re.compile(r'\(([^()]*)\)$')
+
+    def __init__(self):
+        self.byName = {}
+        self.byId = {}
+
+    def index(self, grades):
+        """
+        Adds the given rubrics to the table.
+
+        Parameters
+        ----------
+        grades:
+            The list of rubrics of the students.
+        """
+        for rubric in grades:
+            self.byName[rubric.studentName] = rubric
+            match = self.ID.search(rubric.studentName)
+            if match:
+                self.byId[match.group(1)] = rubric
+
+    def find(self, name = '', id = ''):
+        """
+        Finds the rubric of a student.
+
+        Parameters
+        ----------
+        name:
+            The name of the student directory.
+        id:
+            The ID of the student, used if the name is not found.
+
+        Returns
+        -------
+            The rubric of the student, or None if there is none.
         """
-        Computes the total mark for the student.
+        if name in self.byName:
+            return self.byName[name]
+        return self.byId.get(id)
+
+    def statistics(self):
+        """
+        Computes statistics of the marks of the class.
+
+        Returns
+        -------
+            The average mark of each element of the rubric, and the average,
+            median, lowest, and highest totals. None if the table is empty.
         """
-        for item, mark in self.attributes.items():
-            self.total += mark
+        rubrics = list(self.byName.values())
+        if not rubrics:
+            return None
+
+        averages = [math.fsum(column) / len(rubrics) for column in
+                zip(*(rubric.marks for rubric in rubrics))]
+        totals = sorted(rubric.total for rubric in rubrics)
+        middle = len(totals) // 2
+        if len(totals) % 2:
+            median = totals[middle]
+        else:
+            median = (totals[middle - 1] + totals[middle]) / 2
+        return averages, math.fsum(totals) / len(totals), median, totals[0], \
+                totals[-1]
@@ -0,0 +1,132 @@
+"""
+Shared fixtures of the tests, which mark small classes made up from the Python
+fixture.
+"""
+
+import os
+import shutil
+import sys
+
+import pytest
+
+MARKING = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'marking')
+sys.path.insert(0, MARKING)
+
+import utils
+from utils import Editor, SUBMISSION_DIR
+from marking import readConfigFile
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python')
+
+# A program that prints the expected output, and notes each time it is run in
+# the log so the tests can count the runs.
+PROGRAM = '''open({log!r}, 'a').write({tag!r} + '\\n')
+print("Contents of file:")
+with open('test.txt', 'r') as inFile:
+    for line in inFile.readlines():
+        print(line.rstrip())
+'''
+
+class RecordingEditor(Editor):
+    """
+    An editor that keeps the summary of each student instead of opening them.
+
+    Attributes
+    ----------
+    summaries:
+        The summary shown for each student, keyed by the name of their
+        directory.
+    """
+    def __init__(self):
+        super().__init__()
+        self.summaries = {}
+
+    def run(self, files):
+        for file in files:
+            if os.path.basename(file) == 'summary.txt':
+                name = os.path.basename(os.path.dirname(file)).rsplit('-', 1)[0]
+                with open(file, encoding = 'utf-8') as summary:
+                    self.summaries[name] = summary.read()
+
+class MarkedClass:
+    """
+    A class of students in a temporary directory.
+
+    Attributes
+    ----------
+    dir:
+        The directory holding the class.
+    log:
+        The file the programs note their runs in.
+    """
+    def __init__(self, dir):
+        self.dir = dir
+        self.log = os.path.join(dir, 'runs.log')
+        self.root = os.path.join(dir, 'root')
+        os.makedirs(self.root)
+        shutil.copy(os.path.join(FIXTURE, 'Test.out'), dir)
+        shutil.copy(os.path.join(FIXTURE, 'Test.txt'),
+                os.path.join(dir, 'test.txt'))
+
+    def add(self, name, tag):
+        """
+        Adds a student whose program notes the given tag when it runs.
+        Students with the same tag have the same code.
+        """
+        subDir = os.path.join(self.root, name, SUBMISSION_DIR)
+        os.makedirs(subDir)
+        with open(os.path.join(subDir, 'Test.py'), 'w') as file:
+            file.write(PROGRAM.format(log = self.log, tag = tag))
+
+    def runs(self):
+        """
+        Gets the tags of the programs that ran, in order.
+        """
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as file:
+            return file.read().split()
+
+    def mark(self, io = None, **config):
+        """
+        Marks the class with the given Config settings and IO settings,
+        returning the table of grades and the editor.
+        """
+        lines = ['[Config]', 'root = ' + self.root,
+                'working = ' + os.path.join(self.dir, 'working'),
+                'makeCSV = false', 'makeComments = false']
+        lines += ['{} = {}'.format(key, value) for key, value in
+                config.items() if key != 'cache']
+        lines += ['[Editor]', 'editor = true', '[Language]', 'name = python',
+                '[IO]', 'output = ' + os.path.join(self.dir, 'Test.out'),
+                'diff = true'] + ['{} = {}'.format(key, value) for key, value
+                        in (io or {}).items()] + ['[Aux]',
+                'files = ' + os.path.join(self.dir, 'test.txt')]
+        if config.get('cache'):
+            lines += ['[Cache]']
+        lines += ['[Rubric]', 'item 1 = 1']
+        configPath = os.path.join(self.dir, 'test.ini')
+        with open(configPath, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+
+        conf, marker, rubric = readConfigFile(configPath)
+        marker.editor = RecordingEditor()
+        table = marker.mark(conf.root, rubric)
+
+        # The next session marks the whole class again.
+        os.remove(os.path.join(self.dir, 'working', 'grades.journal'))
+        return table, marker.editor
+
+@pytest.fixture
+def markedClass(tmp_path, monkeypatch):
+    """
+    A class whose students are marked in the order of their names.
+    """
+    scan = utils.Manifest.scan
+    def sortedScan(manifest, root, archive = None):
+        scan(manifest, root, archive)
+        manifest.students = dict(sorted(manifest.students.items()))
+    monkeypatch.setattr(utils.Manifest, 'scan', sortedScan)
+    monkeypatch.chdir(tmp_path)
+    return MarkedClass(str(tmp_path))
@@ -0,0 +1,84 @@
+"""
+Tests of running submissions with the same code only once.
+"""
+
+def test_leader_after_duplicate(markedClass):
+    # A new group starts after a duplicate of the first one.
+    markedClass.add('A, First(a1)', 'a')
+    markedClass.add('B, Copy(a2)', 'a')
+    markedClass.add('C, Other(c1)', 'c')
+    table, editor = markedClass.mark(duplicates = 'true')
+
+    assert sorted(rubric.studentName for rubric in table) == [
+            'A, First(a1)', 'B, Copy(a2)', 'C, Other(c1)']
+    assert sorted(markedClass.runs()) == ['a', 'c']
+
+def results(summary):
+    """
+    Gets the part of a summary before the list of duplicates.
+    """
+    return summary.split('# Duplicate submissions')[0]
+
+def test_results_shared(markedClass):
+    # The duplicate gets the results of the submission that was run, and
+    # each of them lists the other.
+    markedClass.add('A, First(a1)', 'a')
+    markedClass.add('B, Copy(a2)', 'a')
+    markedClass.add('C, Other(c1)', 'c')
+    table, editor = markedClass.mark(duplicates = 'true')
+
+    first = editor.summaries['A, First(a1)']
+    copy = editor.summaries['B, Copy(a2)']
+    other = editor.summaries['C, Other(c1)']
+    assert 'outputs are identical' in results(copy)
+    assert results(copy) == results(first)
+    assert '    B, Copy(a2)\n' in first
+    assert '    A, First(a1)\n' in copy
+    assert 'Duplicate submissions' not in other
+
+def test_groups_interleaved(markedClass):
+    # Groups that start after duplicates of earlier groups, and duplicates
+    # that come after a new group started, are each run once.
+    markedClass.add('A, First(a1)', 'a')
+    markedClass.add('B, Copy(a2)', 'a')
+    markedClass.add('C, Other(c1)', 'c')
+    markedClass.add('D, Copy(a3)', 'a')
+    markedClass.add('E, Copy(c2)', 'c')
+    markedClass.add('F, Last(f1)', 'f')
+    table, editor = markedClass.mark(duplicates = 'true')
+
+    assert [rubric.studentName for rubric in table] == [
+            'A, First(a1)', 'B, Copy(a2)', 'C, Other(c1)', 'D, Copy(a3)',
+            'E, Copy(c2)', 'F, Last(f1)']
+    assert markedClass.runs() == ['a', 'c', 'f']
+    assert '    A, First(a1)\n    B, Copy(a2)\n' in editor.summaries[
+            'D, Copy(a3)']
+    assert '    C, Other(c1)\n' in editor.summaries['E, Copy(c2)']
+
+def test_batch(markedClass):
+    # The worker processes run each group once as well.
+    markedClass.add('A, First(a1)', 'a')
+    markedClass.add('B, Copy(a2)', 'a')
+    markedClass.add('C, Other(c1)', 'c')
+    table, editor = markedClass.mark(duplicates = 'true', batch = 'true')
+
+    assert sorted(rubric.studentName for rubric in table) == [
+            'A, First(a1)', 'B, Copy(a2)', 'C, Other(c1)']
+    assert sorted(markedClass.runs()) == ['a', 'c']
+    assert results(editor.summaries['B, Copy(a2)']) == results(
+            editor.summaries['A, First(a1)'])
+
+def test_cache(markedClass):
+    # Results in the cache are shared with the duplicates too, so a second
+    # session runs nothing.
+    markedClass.add('A, First(a1)', 'a')
+    markedClass.add('B, Copy(a2)', 'a')
+    markedClass.add('C, Other(c1)', 'c')
+    markedClass.mark(duplicates = 'true', cache = True)
+    assert sorted(markedClass.runs()) == ['a', 'c']
+
+    table, editor = markedClass.mark(duplicates = 'true', cache = True)
+    assert len(table) == 3
+    assert sorted(markedClass.runs()) == ['a', 'c']
+    assert 'outputs are identical' in results(editor.summaries['B, Copy(a2)'])
+    assert '    A, First(a1)\n' in editor.summaries['B, Copy(a2)']
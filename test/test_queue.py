@@ -0,0 +1,61 @@
+"""
+Tests of the queue shared by several markers.
+"""
+
+import time
+
+from utils import Rubric, RubricSchema, WorkQueue
+
+SCHEMA = RubricSchema(['Correctness'], [10])
+
+def makeQueue(path, owner, leaseTime = 30 * 60):
+    queue = WorkQueue()
+    queue.path = str(path)
+    queue.owner = owner
+    queue.leaseTime = leaseTime
+    return queue
+
+def makeRubric(name, mark):
+    rubric = Rubric(SCHEMA)
+    rubric.studentName = name
+    rubric.setMark('Correctness', mark)
+    return rubric
+
+def test_record_after_takeover(tmp_path):
+    """
+    A marker whose lease ran out cannot overwrite the grade of the marker that
+    took the student over.
+    """
+    path = tmp_path / 'queue.db'
+    first = makeQueue(path, 'first', leaseTime = 0.1)
+    second = makeQueue(path, 'second')
+    first.add(['A'])
+    assert first.lease() == 'A'
+
+    time.sleep(0.2)
+    assert second.lease() == 'A'
+    assert not first.renew('A')
+    assert second.record(makeRubric('A', 7))
+    assert not first.record(makeRubric('A', 3))
+
+    grades = first.grades(SCHEMA)
+    assert [rubric.marks[0] for rubric in grades] == [7]
+
+def test_heartbeat_keeps_leases(tmp_path):
+    """
+    The heartbeat keeps the leases of a marker from running out while it is
+    busy with a student.
+    """
+    path = tmp_path / 'queue.db'
+    first = makeQueue(path, 'first', leaseTime = 0.3)
+    second = makeQueue(path, 'second')
+    first.add(['A'])
+    assert first.lease() == 'A'
+
+    first.startHeartbeat()
+    try:
+        time.sleep(0.6)
+        assert second.lease() is None
+    finally:
+        first.stopHeartbeat()
+    assert first.record(makeRubric('A', 5))
@@ -0,0 +1,22 @@
+"""
+Tests of running programs on several test cases.
+"""
+
+import os
+
+def test_max_failures_skips_cases(markedClass, monkeypatch):
+    # Every case fails, and only one runs at a time, so the first failure
+    # stops the rest from starting.
+    monkeypatch.setattr(os, 'cpu_count', lambda: 1)
+    testDir = os.path.join(markedClass.dir, 'cases')
+    os.makedirs(testDir)
+    for i in range(1, 4):
+        with open(os.path.join(testDir, 'Test.{}.out'.format(i)), 'w') as file:
+            file.write('Not the output\n')
+    markedClass.add('A, First(a1)', 'a')
+
+    table, editor = markedClass.mark(io = {'tests': testDir,
+        'maxFailures': 1})
+
+    assert markedClass.runs() == ['a']
+    assert 'A, First(a1)' in editor.summaries